@@ -0,0 +1,136 @@
+#   Copyright (c) 2016, Xilinx, Inc.
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Compares the throughput of SimpleMBChannel against the previous
+implementation which re-read both pointers from BRAM on every call and
+concatenated partial reads. Both run against an in-memory buffer in
+place of mmio.mem so only the host-side overhead is measured.
+
+Run with `python3.6 benchmarks/mb_channel.py`
+
+"""
+
+import timeit
+
+import numpy as np
+
+from ipython_microblaze.streams import SimpleMBChannel
+
+__author__ = "Peter Ogden"
+__copyright__ = "Copyright 2017, Xilinx"
+__email__ = "ogden@xilinx.com"
+
+
+class _OldChannel:
+    def __init__(self, buffer, offset=0, length=0):
+        self.control_array = np.frombuffer(buffer, count=2,
+                                           offset=offset, dtype=np.uint32)
+        if not length:
+            length = len(buffer) - offset
+        self.data_array = np.frombuffer(buffer, count=(length - 8),
+                                        offset=offset + 8, dtype=np.uint8)
+        self.length = length - 8
+
+    def write(self, b):
+        written = int(self.control_array[0])
+        read = int(self._safe_control_read(1))
+        available = (read - written - 1 + 2 * self.length) % self.length
+        to_write = min(len(b), available)
+        write_array = np.frombuffer(b, np.uint8)
+        end_block = min(to_write, self.length - written)
+        self.data_array[written:written + end_block] = write_array[0:end_block]
+        if end_block < to_write:
+            self.data_array[0:to_write-end_block] = \
+                write_array[end_block:to_write]
+        self.control_array[0] = (written + to_write) % self.length
+        return to_write
+
+    def read_upto(self, n=-1):
+        written = int(self._safe_control_read(0))
+        read = int(self.control_array[1])
+        available = (written - read + self.length) % self.length
+        if available == 0:
+            return b''
+        if n > 0 and available > n:
+            available = n
+        read_array = np.empty([available], dtype=np.uint8)
+        end_block = min(available, self.length - read)
+        read_array[0:end_block] = self.data_array[read:read + end_block]
+        if end_block < available:
+            read_array[end_block:available] = \
+                self.data_array[0:available - end_block]
+        self.control_array[1] = (read + available) % self.length
+        return read_array.tobytes()
+
+    def read(self, n=-1):
+        data = self.read_upto(n)
+        while len(data) != n and n != -1:
+            data += self.read_upto(n-len(data))
+        return data
+
+    def _safe_control_read(self, index):
+        last_value = self.control_array[index]
+        value = self.control_array[index]
+        while value != last_value:
+            last_value = value
+            value = self.control_array[index]
+        return value
+
+
+def _loopback(channel_class, chunk, total):
+    mem = bytearray(0x400)
+    writer = channel_class(mem)
+    reader = channel_class(mem)
+    data = bytes(range(256)) * (chunk // 256 + 1)
+    data = data[:chunk]
+    buf = bytearray(chunk)
+
+    def transfer():
+        for _ in range(total // chunk):
+            writer.write(data)
+            if hasattr(reader, 'readinto'):
+                reader.readinto(buf)
+            else:
+                reader.read(chunk)
+    return transfer
+
+
+def run(chunk, total=1024 * 1024):
+    old = min(timeit.repeat(_loopback(_OldChannel, chunk, total),
+                            number=1, repeat=3))
+    new = min(timeit.repeat(_loopback(SimpleMBChannel, chunk, total),
+                            number=1, repeat=3))
+    size = total / (1024 * 1024)
+    print(f'chunk {chunk:4}: old {size / old:8.1f} MB/s, '
+          f'new {size / new:8.1f} MB/s ({old / new:5.1f}x)')
+
+
+if __name__ == '__main__':
+    for chunk in [4, 64, 512, 1000]:
+        run(chunk)
@@ -0,0 +1,94 @@
+#   Copyright (c) 2016, Xilinx, Inc.
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Compares encoding and decoding throughput of pointer arguments
+using the NumPy based wrappers against the previous per-element
+struct packing.
+
+Run on the board with `python3.6 benchmarks/pointer_encode.py`
+
+"""
+
+import struct
+import timeit
+
+import numpy as np
+from pycparser import c_ast
+
+from ipython_microblaze.rpc import PointerWrapper
+
+__author__ = "Peter Ogden"
+__copyright__ = "Copyright 2017, Xilinx"
+__email__ = "ogden@xilinx.com"
+
+
+class _BytesStream:
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def read(self, n):
+        data = self.data[self.offset:self.offset + n]
+        self.offset += n
+        return data
+
+
+def struct_encode(struct_string, val):
+    packed = struct.pack('<' + struct_string * len(val), *val)
+    return struct.pack('h', len(val)) + packed
+
+
+def struct_decode(struct_string, val, data):
+    length = struct.unpack('h', data[0:2])[0]
+    val[:] = struct.unpack('<' + struct_string * length, data[2:])
+
+
+def run(struct_string, dtype, length, repeat=200):
+    wrapper = PointerWrapper(
+        c_ast.PtrDecl([], c_ast.TypeDecl('arg', [], None)), struct_string)
+    array = np.arange(length, dtype=dtype)
+    values = array.tolist()
+    encoded = wrapper.param_encode(array) + wrapper.param_data(array)
+    assert encoded == struct_encode(struct_string, values)
+
+    old = timeit.timeit(lambda: struct_decode(
+        struct_string, values, struct_encode(struct_string, values)),
+        number=repeat)
+    new = timeit.timeit(lambda: wrapper.param_decode(
+        array, _BytesStream(wrapper.param_encode(array) +
+                            wrapper.param_data(array))), number=repeat)
+    size = len(encoded) * repeat / (1024 * 1024)
+    print(f'{struct_string} x {length:6}: struct {size / old:8.1f} MB/s, '
+          f'numpy {size / new:8.1f} MB/s ({old / new:5.1f}x)')
+
+
+if __name__ == '__main__':
+    for length in [16, 256, 4096]:
+        run('B', np.uint8, length)
+        run('l', np.int32, length)
@@ -68,6 +68,18 @@ void _handle_events() {
 }*/
 
 static void volatile_cpy(volatile char* dest, volatile char* src, int len) {
+	// Copy whole words when both sides are aligned as it takes a quarter
+	// of the BRAM accesses
+	if ((((intptr_t)dest | (intptr_t)src) & 3) == 0) {
+		volatile int32_t* dest_word = (volatile int32_t*)dest;
+		volatile int32_t* src_word = (volatile int32_t*)src;
+		while (len >= 4) {
+			*dest_word++ = *src_word++;
+			len -= 4;
+		}
+		dest = (volatile char*)dest_word;
+		src = (volatile char*)src_word;
+	}
 	while (len-- > 0) {
 		*dest++ = *src++;
 	}
@@ -33,10 +33,21 @@ __email__ = "ogden@xilinx.com"
 
 from .bsp import BSPs
 from .bsp import Modules
+from .compile import BuildReport
 from .compile import MicroblazeProgram
+from .compile import compile_programs
 from .rpc import MicroblazeRPC
 from .rpc import MbioRPC
 from .rpc import IopRPC
+from .rpc import ResidentRPC
+from .rpc import compile_rpcs
+from .buffers import SharedBufferPool
+from .pool import RPCPool
+from .sampling import SampleStream
+from .stats import CallTimeline
+from .stats import RPCStats
+from .streams import MailboxLayout
+from .streams import StdoutPump
 
 from IPython.core.magic import cell_magic, Magics, magics_class
 from IPython import get_ipython
@@ -75,8 +86,17 @@ class MicroblazeMagics(Magics):
             return HTML("<pre>Usage: %%microblaze PMOD variable [libraries]</pre>")
         
         mb_info = self.name2obj(mb_name)
+        existing = self.shell.user_ns.get(var)
         try:
-            program = MicroblazeProgram(mb_info, "\n" + cell)
+            # Re-running a cell swaps the program in place which only
+            # writes the parts of memory that changed
+            if (isinstance(existing, MicroblazeProgram) and
+                    existing.ip_name == getattr(mb_info, 'mb_info',
+                                                mb_info)['ip_name']):
+                existing.load("\n" + cell)
+                program = existing
+            else:
+                program = MicroblazeProgram(mb_info, "\n" + cell)
         except RuntimeError as r:
             return HTML("<pre>Compile FAILED\n" + r.args[0] + "</pre>")
             return None
@@ -87,11 +107,19 @@ class MicroblazeMagics(Magics):
     def microblaze_functions(self, line, cell):
         mb_info = self.name2obj(line)
         try:
-            program = MicroblazeRPC(mb_info, '#line 1 "cell_magic"\n\n' + cell)
+            # Functions are added to a resident server rather than
+            # replacing the program running on the Microblaze
+            if isinstance(mb_info, ResidentRPC):
+                program = mb_info
+                functions = program.add_functions(
+                    '#line 1 "cell_magic"\n\n' + cell)
+            else:
+                program = MicroblazeRPC(mb_info, '#line 1 "cell_magic"\n\n' + cell)
+                functions = program.visitor.functions
         except RuntimeError as r:
             return HTML("<pre>Compile FAILED\n" + r.args[0] + "</pre>")
             return None
-        for name, adapter in program.visitor.functions.items():
+        for name, adapter in functions.items():
             if adapter.filename == "cell_magic":
                 self.shell.user_ns.update({name: _FunctionWrapper(getattr(program, name), program)})
              
@@ -32,10 +32,80 @@ __copyright__ = "Copyright 2017, Xilinx"
 __email__ = "ogden@xilinx.com"
 
 from os import path, listdir
+from subprocess import run, PIPE
 import re
+import tempfile
+
+from .cache import CACHE_DIR
+from .cache import FileCache
+from .cache import hash_file
+from .cache import hash_key
+
+
+archive_cache = FileCache(path.join(CACHE_DIR, 'archives'),
+                          max_size=64 * 1024 * 1024)
+
+
+def _headers(include_path):
+    headers = []
+    for include_dir in include_path:
+        if not path.isdir(include_dir):
+            continue
+        for f in sorted(listdir(include_dir)):
+            if re.match(r".*\.h$", f):
+                headers.append(path.join(include_dir, f))
+    return headers
+
+
+def _build_archive(name, sources, cflags, include_path):
+    """Compiles `sources` into a static library, reusing a cached
+    copy if none of the sources, headers or flags have changed
+
+    """
+    if not sources:
+        return None
+    libname = f'lib{name}.a'
+    compile_flags = [f for f in cflags if not f.startswith('-l')]
+    files = sorted(sources) + _headers(include_path)
+    key = hash_key(name, compile_flags, include_path,
+                   [(f, hash_file(f)) for f in files])
+    # Concurrent builds for the same BSP wait for the first to finish
+    with archive_cache.lock(key):
+        entry = archive_cache.lookup(key)
+        if entry is None:
+            with tempfile.TemporaryDirectory() as tempdir:
+                objects = []
+                for i, source in enumerate(sorted(sources)):
+                    obj = path.join(tempdir, f'{i}_{path.basename(source)}.o')
+                    args = ['mb-gcc', '-c', '-o', obj]
+                    args.extend(compile_flags)
+                    for include_dir in include_path:
+                        args.append('-I')
+                        args.append(include_dir)
+                    args.append(source)
+                    result = run(args, stdout=PIPE, stderr=PIPE)
+                    if result.returncode:
+                        raise RuntimeError(result.stderr.decode())
+                    objects.append(obj)
+                result = run(['mb-ar', 'rcs', path.join(tempdir, libname)] +
+                             objects, stdout=PIPE, stderr=PIPE)
+                if result.returncode:
+                    raise RuntimeError("Archive failed:\n" +
+                                       result.stderr.decode())
+                entry = archive_cache.store(key, tempdir, [libname])
+    return path.join(entry, libname)
+
+
+def _all_include_paths(bsp):
+    include_path = list(bsp.include_path)
+    for module in Modules.values():
+        include_path.extend(module.include_path)
+    return include_path
+
 
 class Module:
     def __init__(self, root, compatible=None):
+        self.name = path.basename(path.normpath(root))
         self.include_path = [
             path.join(root, 'include')
         ]
@@ -67,8 +137,17 @@ class Module:
                  with open(path.join(root, 'include', f), 'r') as data:
                      self.header += data.read()
 
+    def archive(self, bsp):
+        """Returns the path to a static library of the module's sources
+        compiled for `bsp` or None if the module has no sources
+
+        """
+        return _build_archive(f'module_{self.name}', self.sources, bsp.cflags,
+                              _all_include_paths(bsp))
+
 class BSPInstance:
     def __init__(self, root):
+        self.name = path.basename(path.normpath(root))
         self.include_path = [
             path.join(root, 'include')
         ]
@@ -96,6 +175,14 @@ class BSPInstance:
                 if match:
                     self.sources.append(path.join(root, 'src', f))
 
+    def archive(self):
+        """Returns the path to a static library of the BSP's sources
+        or None if the BSP has no sources
+
+        """
+        return _build_archive(f'bsp_{self.name}', self.sources, self.cflags,
+                              _all_include_paths(self))
+
 
 SCRIPT_DIR = path.dirname(path.realpath(__file__))
 BSP_DIR = path.join(SCRIPT_DIR, 'bsp')
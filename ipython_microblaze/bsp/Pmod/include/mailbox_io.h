@@ -13,4 +13,26 @@ ssize_t mailbox_write(int file, const void* ptr, size_t len);
 long mailbox_lseek(int fd, long offset, int whence);
 int mailbox_available(int fd);
 
+// Blocking variants of mailbox_read and mailbox_write that transfer the
+// whole of ptr, used for moving arrays of samples through a channel
+static inline ssize_t mailbox_read_array(int fd, void* ptr, size_t len) {
+	size_t done = 0;
+	while (done < len) {
+		ssize_t ret = mailbox_read(fd, (char*)ptr + done, len - done);
+		if (ret < 0) return ret;
+		done += ret;
+	}
+	return done;
+}
+
+static inline ssize_t mailbox_write_array(int fd, const void* ptr, size_t len) {
+	size_t done = 0;
+	while (done < len) {
+		ssize_t ret = mailbox_write(fd, (const char*)ptr + done, len - done);
+		if (ret < 0) return ret;
+		done += ret;
+	}
+	return done;
+}
+
 #endif
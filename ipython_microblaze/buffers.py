@@ -0,0 +1,160 @@
+#   Copyright (c) 2016, Xilinx, Inc.
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import collections
+from pynq import Xlnk
+
+__author__ = "Peter Ogden"
+__copyright__ = "Copyright 2017, Xilinx"
+__email__ = "ogden@xilinx.com"
+
+
+class SharedBufferPool:
+    """Pool of contiguous DDR buffers shared with an RPC instance
+
+    Buffers are passed to functions taking a `void*` argument, which
+    receive the physical address of the buffer so data never passes
+    through the mailbox. The buffers are used in rotation so the host
+    can work on one buffer while the Microblaze fills or consumes the
+    others - two buffers give double buffering, three triple buffering.
+    A fence is posted after each submitted call so that a buffer is only
+    handed back once the Microblaze has finished with it.
+
+    Only calls to functions without a return value overlap with the
+    host as calls with a return value wait for their response.
+
+    """
+    def __init__(self, rpc, shape, dtype, count=2, xlnk=None):
+        """Allocate the buffers
+
+        Parameters
+        ----------
+        rpc   : MicroblazeRPC
+            RPC instance whose functions will use the buffers
+        shape : int or tuple
+            Shape of each buffer
+        dtype : numpy.dtype
+            Element type of each buffer
+        count : int
+            Number of buffers to rotate through
+        xlnk  : pynq.Xlnk
+            Allocator to use, a new one is created if not specified
+
+        """
+        if count < 1:
+            raise RuntimeError("A buffer pool needs at least one buffer")
+        if xlnk is None:
+            xlnk = Xlnk()
+        self._rpc = rpc
+        self.buffers = [xlnk.cma_array(shape=shape, dtype=dtype)
+                        for _ in range(count)]
+        self._marks = [0] * count
+        self._next = 0
+
+    def _index(self, buffer):
+        for i, b in enumerate(self.buffers):
+            if b is buffer:
+                return i
+        raise RuntimeError("Buffer does not belong to this pool")
+
+    def acquire(self):
+        """Returns the next buffer in the rotation, waiting until the
+        Microblaze has finished with it
+
+        """
+        index = self._next
+        self._next = (index + 1) % len(self.buffers)
+        self._rpc.wait(self._marks[index])
+        return self.buffers[index]
+
+    def submit(self, function, buffer, *args):
+        """Calls `function(buffer, *args)` and marks `buffer` as in use
+        until the call has completed
+
+        """
+        result = function(buffer, *args)
+        self._marks[self._index(buffer)] = self._rpc.post_fence()
+        return result
+
+    def fill(self, function, *args, count=None):
+        """Generator returning buffers filled by `function(buffer, *args)`
+
+        Every buffer in the pool is kept queued on the Microblaze so it
+        fills the next buffers while the host processes the one
+        returned. A returned buffer is refilled once the generator is
+        resumed so copy out any data needed after that.
+
+        Parameters
+        ----------
+        function : callable
+            RPC function taking the buffer as its first argument
+        args     :
+            Further arguments passed to `function`
+        count    : int
+            Number of buffers to return, unlimited if not specified
+
+        """
+        in_flight = collections.deque()
+        remaining = count
+
+        def queue():
+            buffer = self.acquire()
+            self.submit(function, buffer, *args)
+            in_flight.append(buffer)
+
+        while len(in_flight) < len(self.buffers) and remaining != 0:
+            queue()
+            remaining = None if remaining is None else remaining - 1
+        while in_flight:
+            buffer = in_flight.popleft()
+            self._rpc.wait(self._marks[self._index(buffer)])
+            yield buffer
+            if remaining != 0:
+                queue()
+                remaining = None if remaining is None else remaining - 1
+
+    def feed(self, function, chunks, *args):
+        """Copies each chunk into a buffer and passes it to
+        `function(buffer, *args)` without waiting for the previous
+        buffers to be consumed
+
+        """
+        for chunk in chunks:
+            buffer = self.acquire()
+            buffer[...] = chunk
+            self.submit(function, buffer, *args)
+
+    def close(self):
+        """Waits for all outstanding calls and frees the buffers
+
+        """
+        self._rpc.fence()
+        for buffer in self.buffers:
+            buffer.close()
+        self.buffers = []
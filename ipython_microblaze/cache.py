@@ -0,0 +1,266 @@
+#   Copyright (c) 2016, Xilinx, Inc.
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import contextlib
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+from os import path
+
+__author__ = "Peter Ogden"
+__copyright__ = "Copyright 2017, Xilinx"
+__email__ = "ogden@xilinx.com"
+
+
+CACHE_DIR = os.environ.get(
+    'IPYTHON_MICROBLAZE_CACHE',
+    path.join(path.expanduser('~'), '.cache', 'ipython_microblaze'))
+
+# Digests of files keyed by filename and validated against the mtime
+# and size so that unchanged headers are only hashed once per session
+_file_digests = {}
+
+
+def hash_file(filename):
+    """Returns the SHA-256 digest of the contents of a file
+
+    """
+    st = os.stat(filename)
+    cached = _file_digests.get(filename)
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+    with open(filename, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    _file_digests[filename] = (st.st_mtime_ns, st.st_size, digest)
+    return digest
+
+
+def _update_hash(h, part):
+    if isinstance(part, (list, tuple)):
+        h.update(b'[%d' % len(part))
+        for p in part:
+            _update_hash(h, p)
+        h.update(b']')
+    elif isinstance(part, (set, frozenset)):
+        _update_hash(h, sorted(part))
+    else:
+        if isinstance(part, str):
+            part = part.encode()
+        elif not isinstance(part, bytes):
+            part = repr(part).encode()
+        h.update(b'%d:' % len(part))
+        h.update(part)
+
+
+def hash_key(*parts):
+    """Combines strings, bytes and nested lists or sets of them into
+    a single hexadecimal cache key
+
+    """
+    h = hashlib.sha256()
+    _update_hash(h, parts)
+    return h.hexdigest()
+
+
+class FileCache:
+    """Size-bounded on-disk cache of build products
+
+    Each entry is a directory named by its key containing one or more
+    files. Entries are evicted in least-recently-used order once the
+    total size exceeds `max_size`.
+
+    Attributes
+    ----------
+    root      : str
+        Directory holding the cache entries
+    max_size  : int
+        Maximum total size of all entries in bytes
+    hits      : int
+        Number of successful lookups this session
+    misses    : int
+        Number of failed lookups this session
+    evictions : int
+        Number of entries removed to keep within `max_size`
+
+    """
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def _lock_dir(self):
+        return path.join(self.root, '.locks')
+
+    def lookup(self, key):
+        """Returns the directory of the entry for `key` or None if
+        there is no such entry
+
+        """
+        entry = path.join(self.root, key)
+        try:
+            # Touching the entry marks it as recently used
+            os.utime(entry)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        """Context manager holding an exclusive lock on `key` so that
+        concurrent processes building the same entry wait for the first
+        one rather than duplicating the work
+
+        """
+        os.makedirs(self._lock_dir, exist_ok=True)
+        lock_file = path.join(self._lock_dir, key)
+        while True:
+            f = open(lock_file, 'a')
+            fcntl.flock(f, fcntl.LOCK_EX)
+            # The lock file may have been removed while waiting for it in
+            # which case the lock is on a file nobody else can see
+            try:
+                if os.fstat(f.fileno()).st_ino == os.stat(lock_file).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            f.close()
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+
+    def store(self, key, source_dir, filenames):
+        """Copies `filenames` from `source_dir` into a new entry for
+        `key` and returns the directory of the entry
+
+        """
+        os.makedirs(self.root, exist_ok=True)
+        staging = tempfile.mkdtemp(prefix='.staging-', dir=self.root)
+        for filename in filenames:
+            shutil.copy(path.join(source_dir, filename), staging)
+        entry = path.join(self.root, key)
+        try:
+            os.rename(staging, entry)
+        except OSError:
+            # Somebody else stored the same entry first
+            shutil.rmtree(staging, ignore_errors=True)
+        self.evict(keep=key)
+        return entry
+
+    def _entries(self):
+        entries = []
+        if not path.isdir(self.root):
+            return entries
+        for name in os.listdir(self.root):
+            if name.startswith('.'):
+                continue
+            entry = path.join(self.root, name)
+            try:
+                mtime = os.stat(entry).st_mtime
+                size = sum(os.stat(path.join(entry, f)).st_size
+                           for f in os.listdir(entry))
+            except OSError:
+                continue
+            entries.append((mtime, size, name))
+        return entries
+
+    def evict(self, keep=None):
+        """Removes the least recently used entries until the cache
+        fits within `max_size`
+
+        """
+        entries = sorted(self._entries())
+        total = sum(e[1] for e in entries)
+        for mtime, size, name in entries:
+            if total <= self.max_size:
+                break
+            if name == keep:
+                continue
+            self._remove(name)
+            total -= size
+            self.evictions += 1
+
+    def clear(self):
+        """Removes all entries from the cache
+
+        """
+        for mtime, size, name in self._entries():
+            self._remove(name)
+        # Lock files are also left behind by builds that failed
+        if path.isdir(self._lock_dir):
+            for name in os.listdir(self._lock_dir):
+                self._remove_lock(name)
+
+    def _remove(self, name):
+        shutil.rmtree(path.join(self.root, name), ignore_errors=True)
+        self._remove_lock(name)
+
+    def _remove_lock(self, name):
+        # Only remove the lock file while holding the lock so a waiting
+        # process notices and retries on a new file. Locks in use are
+        # left for their holder.
+        lock_file = path.join(self._lock_dir, name)
+        try:
+            f = open(lock_file, 'r')
+        except OSError:
+            return
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return
+            try:
+                if os.fstat(f.fileno()).st_ino == os.stat(lock_file).st_ino:
+                    os.unlink(lock_file)
+            except OSError:
+                pass
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def stats(self):
+        """Returns a dictionary of the hit, miss and eviction counts
+        along with the current number and size of the entries
+
+        """
+        entries = self._entries()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(entries),
+            'size': sum(e[1] for e in entries)
+        }
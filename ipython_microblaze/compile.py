@@ -29,13 +29,24 @@
 
 from pynq.lib import PynqMicroblaze
 from pynq import PL
+import numpy as np
 
+from contextlib import contextmanager
 from os import path
 import tempfile
 import shutil
+import struct
+import time
+from concurrent.futures import ProcessPoolExecutor
 from subprocess import run, PIPE
 
+from .cache import CACHE_DIR
+from .cache import FileCache
+from .cache import hash_file
+from .cache import hash_key
+from .streams import DEFAULT_LAYOUT
 from .streams import InterruptMBStream
+from .streams import StdoutPump
 from . import BSPs
 from . import Modules
 
@@ -44,33 +55,239 @@ __copyright__ = "Copyright 2017, Xilinx"
 __email__ = "ogden@xilinx.com"
 
 
-def dependencies(source, bsp):
-    args = ['mb-cpp', '-MM']
-    for include_path in bsp.include_path:
-        args.append('-I')
-        args.append(include_path)
-    paths = {}
-    for name, module in Modules.items():
-        for include_path in module.include_path:
-            args.append('-I')
-            args.append(include_path)
-            paths[include_path] = name
-    source = source.replace('__extension__', '')
-    result = run(args, stdout=PIPE, stderr=PIPE, input=source.encode())
-    if result.returncode:
-        raise RuntimeError("Preprocessor failed: \n" + result.stderr.decode())
-    dependent_paths = result.stdout.decode()
-    dependent_modules = {v for k, v in paths.items()
-                         if dependent_paths.find(k) != -1 }
-    return [Modules[k] for k in dependent_modules]
-     
+program_cache = FileCache(path.join(CACHE_DIR, 'programs'),
+                          max_size=64 * 1024 * 1024)
 
-def preprocess(source, bsp=None, mb_info=None):
+
+def _library_files(library_path, libraries):
+    files = []
+    for lib in libraries:
+        for lib_path in library_path:
+            candidate = path.join(lib_path, f'lib{lib}.a')
+            if path.exists(candidate):
+                files.append(candidate)
+                break
+    return files
+
+
+def _program_key(source, bsp, module_names, headers, layout, reserve=0):
+    """Computes the cache key for a program from everything that
+    can affect the resulting binary
+
+    """
+    modules = [Modules[k] for k in module_names]
+    files = list(headers)
+    files.append(bsp.linker_script)
+    files.extend(bsp.sources)
+    files.extend(_library_files(bsp.library_path, bsp.libraries))
+    for module in modules:
+        files.extend(module.sources)
+        files.extend(_library_files(module.library_path, module.libraries))
+    return hash_key(source, bsp.cflags, bsp.ldflags, module_names,
+                    layout.channels, layout.top, reserve,
+                    [(f, hash_file(f)) for f in files])
+
+
+class Preprocessed:
+    """Result of running the preprocessor over a source
+
+    Attributes
+    ----------
+    text    : str
+        Expanded source suitable for pycparser
+    modules : [str]
+        Names of the modules whose headers are included
+    headers : [str]
+        Non-system headers included by the source
+
+    """
+    def __init__(self, text, modules, headers):
+        self.text = text
+        self.modules = modules
+        self.headers = headers
+
+    def merge(self, other):
+        """Returns the combined dependencies of two sources
+
+        """
+        return Preprocessed(self.text + other.text,
+                            sorted(set(self.modules) | set(other.modules)),
+                            sorted(set(self.headers) | set(other.headers)))
+
+
+class BuildReport:
+    """Where the time went in building a program and how much of the
+    Microblaze's memory the program uses
+
+    Attributes
+    ----------
+    stages       : {str: float}
+        Wall time in seconds of each stage of the build in the order
+        they ran. Stages skipped because of caching are missing
+    modules      : [str]
+        Names of the modules the program depends on
+    headers      : [str]
+        Non-system headers included by the program
+    cache_hit    : bool
+        Whether the program was already in the compile cache
+    entry        : str
+        Cache directory holding the program
+    sections     : [(str, int, int)]
+        Name, address and size of each section loaded into memory
+    text         : int
+        Bytes of code and read-only data
+    data         : int
+        Bytes of initialised data
+    bss          : int
+        Bytes of zero-initialised data excluding the heap and stack
+    heap         : int
+        Bytes reserved for the heap
+    stack        : int
+        Bytes reserved for the stack
+    end          : int
+        Address of the end of the program including heap and stack
+    limit        : int
+        Address the program must end before, the start of the mailbox
+        channels less any reserved memory
+    mailbox_base : int
+        Address of the start of the mailbox channels
+
+    """
+    def __init__(self):
+        self.stages = {}
+        self.modules = []
+        self.headers = []
+        self.cache_hit = None
+        self.entry = None
+        self.sections = []
+        self.text = self.data = self.bss = self.heap = self.stack = 0
+        self.end = 0
+        self.limit = 0
+        self.mailbox_base = 0
+
+    @contextmanager
+    def stage(self, name):
+        """Adds the time spent in the `with` block to stage `name`
+
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = (self.stages.get(name, 0.0) +
+                                 time.perf_counter() - start)
+
+    def read_elf(self, elf_file, limit, mailbox_base):
+        """Fills in the memory usage from the program in `elf_file`
+
+        """
+        self.limit = limit
+        self.mailbox_base = mailbox_base
+        self.sections = []
+        self.text = self.data = self.bss = self.heap = self.stack = 0
+        self.end = 0
+        for name, type_, flags, addr, size in _elf_sections(elf_file):
+            if not flags & _SHF_ALLOC or not size:
+                continue
+            self.sections.append((name, addr, size))
+            self.end = max(self.end, addr + size)
+            if name == '.heap':
+                self.heap += size
+            elif name == '.stack':
+                self.stack += size
+            elif type_ == _SHT_NOBITS:
+                self.bss += size
+            elif flags & _SHF_WRITE:
+                self.data += size
+            else:
+                self.text += size
+
+    @property
+    def total_time(self):
+        return sum(self.stages.values())
+
+    @property
+    def free(self):
+        """Bytes left between the end of the program and the limit
+
+        """
+        return self.limit - self.end
+
+    def as_dict(self):
+        return {'stages': dict(self.stages), 'total_time': self.total_time,
+                'modules': self.modules, 'headers': self.headers,
+                'cache_hit': self.cache_hit, 'entry': self.entry,
+                'sections': [{'name': n, 'address': a, 'size': s}
+                             for n, a, s in self.sections],
+                'text': self.text, 'data': self.data, 'bss': self.bss,
+                'heap': self.heap, 'stack': self.stack, 'end': self.end,
+                'limit': self.limit, 'mailbox_base': self.mailbox_base,
+                'free': self.free}
+
+    def summary(self):
+        lines = ['Build ' + ('cache hit' if self.cache_hit else 'compiled') +
+                 f' in {self.total_time * 1000:.1f} ms']
+        for name, seconds in self.stages.items():
+            lines.append(f'  {name:<12}{seconds * 1000:>10.1f} ms')
+        lines.append('Modules: ' + (', '.join(self.modules) or 'none'))
+        lines.append(f'Memory: text {self.text} data {self.data} '
+                     f'bss {self.bss} heap {self.heap} stack {self.stack}')
+        if self.limit:
+            lines.append(f'  ends at {self.end:#06x} of {self.limit:#06x} '
+                         f'({100 * self.end / self.limit:.1f}%), '
+                         f'{self.free} bytes free, mailbox at '
+                         f'{self.mailbox_base:#06x}')
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return self.summary()
+
+
+# Memoized preprocessor results keyed by source and include set
+_preprocessed = {}
+_header_index = {}
+_header_index_modules = set()
+
+
+def _module_for_header(header):
+    """Looks up which module a header belongs to using an index of
+    include directories that is rebuilt when `Modules` changes
+
+    """
+    global _header_index_modules
+    if _header_index_modules != set(Modules):
+        _header_index.clear()
+        for name, module in Modules.items():
+            for include_path in module.include_path:
+                _header_index[path.normpath(include_path)] = name
+        _header_index_modules = set(Modules)
+    directory = path.dirname(header)
+    while directory:
+        if directory in _header_index:
+            return _header_index[directory]
+        parent = path.dirname(directory)
+        if parent == directory:
+            break
+        directory = parent
+    return None
+
+
+def _resolve_bsp(bsp, mb_info):
     if bsp is None:
         if mb_info is None:
             raise RuntimeError("Must provide either a BSP or mb_info")
+        if hasattr(mb_info, 'mb_info'):
+            mb_info = mb_info.mb_info
         bsp = BSPs[mb_info['mbtype']]
+    return bsp
+
+
+def preprocess_full(source, bsp=None, mb_info=None):
+    """Runs the preprocessor once to produce both the expanded source
+    and the list of modules and headers it depends on
 
+    """
+    bsp = _resolve_bsp(bsp, mb_info)
     args = ['mb-cpp', '-D__attribute__(x)=', '-D__extension__=', '-D__asm__(x)=']
     for include_path in bsp.include_path:
         args.append('-I')
@@ -80,73 +297,533 @@ def preprocess(source, bsp=None, mb_info=None):
             args.append('-I')
             args.append(include_path)
 
+    key = hash_key(source, args)
+    cached = _preprocessed.get(key)
+    if cached:
+        result, digests = cached
+        try:
+            if [hash_file(h) for h in result.headers] == digests:
+                return result
+        except OSError:
+            pass
+
     source = "typedef int __builtin_va_list;\n" + source
-    result = run(args, stdout=PIPE, stderr=PIPE, input=source.encode())
-    return result.stdout.decode()
+    with tempfile.TemporaryDirectory() as tempdir:
+        depfile = path.join(tempdir, 'deps.d')
+        result = run(args + ['-MMD', '-MF', depfile, '-MT', 'main'],
+                     stdout=PIPE, stderr=PIPE, input=source.encode())
+        if result.returncode:
+            raise RuntimeError("Preprocessor failed: \n" +
+                               result.stderr.decode())
+        with open(depfile, 'r') as f:
+            dependent_paths = f.read()
+    headers = sorted({path.normpath(f) for f in dependent_paths.split()
+                      if path.isfile(f)})
+    modules = {_module_for_header(h) for h in headers}
+    modules.discard(None)
+    preprocessed = Preprocessed(result.stdout.decode(), sorted(modules),
+                                headers)
+    _preprocessed[key] = (preprocessed,
+                          [hash_file(h) for h in preprocessed.headers])
+    return preprocessed
+
+
+def preprocess(source, bsp=None, mb_info=None):
+    return preprocess_full(source, bsp, mb_info).text
+
+
+def dependencies(source, bsp):
+    return [Modules[k] for k in preprocess_full(source, bsp).modules]
+
+
+def _toolchain_args(bsp, modules):
+    """Returns the include arguments and the link inputs for a program
+    built against `bsp` and `modules`
+
+    """
+    include_args = []
+    link_args = []
+    lib_args = []
+    for include_path in bsp.include_path:
+        include_args.append('-I')
+        include_args.append(include_path)
+    for lib_path in bsp.library_path:
+        lib_args.append('-L')
+        lib_args.append(lib_path)
+    for lib in bsp.libraries:
+        lib_args.append(f'-l{lib}')
+
+    # Library code is compiled once into cached archives so only the
+    # program itself is compiled here
+    archives = [a for a in [bsp.archive()] + [m.archive(bsp) for m in modules]
+                if a]
+    if archives:
+        link_args.append('-Wl,--start-group')
+        link_args.extend(archives)
+        link_args.append('-Wl,--end-group')
+
+    for module in modules:
+        for include_path in module.include_path:
+             include_args.append('-I')
+             include_args.append(include_path)
+        for lib_path in module.library_path:
+             lib_args.append('-L')
+             lib_args.append(lib_path)
+        for lib in module.libraries:
+             lib_args.append(f'-l{lib}')
+    return include_args, link_args + lib_args
+
+
+def _objcopy(tempdir, flags=[]):
+    result = run(['mb-objcopy', '-O', 'binary'] + flags +
+                 [path.join(tempdir, 'a.out'),
+                  path.join(tempdir, 'a.bin')],
+                 stderr=PIPE)
+    if result.returncode:
+        raise RuntimeError("Objcopy failed:\n" + result.stderr.decode())
+
+
+def _compile(source, bsp, modules, tempdir, layout=DEFAULT_LAYOUT, reserve=0,
+             report=None):
+    """Compiles `source` into a.out and a.bin inside `tempdir`, timing
+    each stage in `report`
+
+    """
+    if report is None:
+        report = BuildReport()
+    args = ['mb-gcc', '-o', path.join(tempdir, 'a.out') ]
+    args.extend(bsp.cflags)
+    with report.stage('archives'):
+        include_args, link_args = _toolchain_args(bsp, modules)
+    args.extend(include_args)
+    linker_script = bsp.linker_script
+    if layout != DEFAULT_LAYOUT or reserve:
+        # Shrink the program's memory so the linker fails if the program
+        # overlaps with the mailbox channels or reserved memory
+        with open(bsp.linker_script, 'r') as f:
+            script = layout.linker_script(f.read(), reserve)
+        linker_script = path.join(tempdir, 'lscript.ld')
+        with open(linker_script, 'w') as f:
+            f.write(script)
+    args.append(f'-Wl,{linker_script}')
+    args.extend(bsp.ldflags)
+
+    with open(path.join(tempdir, 'main.c'), 'w') as f:
+        f.write(source)
+    with report.stage('compile'):
+        result = run(args + [path.join(tempdir, 'main.c')] + link_args,
+                     stdout=PIPE, stderr=PIPE)
+    if result.returncode:
+        raise RuntimeError(result.stderr.decode())
+    with report.stage('objcopy'):
+        _objcopy(tempdir)
+
+
+# Overlays are placed entirely in the reserved region with the table of
+# their entry points first so the loader can find them in the image
+_overlay_script = """ENTRY(_rpc_overlay)
+MEMORY
+{{
+   overlay : ORIGIN = {origin:#x}, LENGTH = {length:#x}
+}}
+SECTIONS
+{{
+   .overlay_header : {{ KEEP(*(.overlay_header)) }} > overlay
+   .text : {{ *(.text .text.*) }} > overlay
+   .rodata : {{ *(.rodata .rodata.* .sdata2 .sdata2.* .sbss2 .sbss2.*) }} > overlay
+   .data : {{ *(.data .data.* .sdata .sdata.*) }} > overlay
+   .bss : {{ *(.bss .bss.* .sbss .sbss.* COMMON) }} > overlay
+   /DISCARD/ : {{ *(.comment .eh_frame .note.*) }}
+}}
+"""
+
+
+def _compile_overlay(source, bsp, modules, tempdir, kernel, origin, length):
+    """Compiles `source` into a.out and a.bin inside `tempdir` to run
+    from `origin` alongside the program in the ELF file `kernel`
+
+    """
+    script = path.join(tempdir, 'overlay.ld')
+    with open(script, 'w') as f:
+        f.write(_overlay_script.format(origin=origin, length=length))
+    # Small data is addressed relative to the kernel's anchors so it is
+    # disabled and there is no startup code as the kernel is running
+    args = ['mb-gcc', '-o', path.join(tempdir, 'a.out'),
+            '-G', '0', '-nostartfiles']
+    args.extend(bsp.cflags)
+    include_args, link_args = _toolchain_args(bsp, modules)
+    args.extend(include_args)
+    args.append(f'-Wl,-T,{script}')
+    args.append(f'-Wl,--just-symbols={kernel}')
+    args.extend(bsp.ldflags)
+
+    with open(path.join(tempdir, 'main.c'), 'w') as f:
+        f.write(source)
+    result = run(args + [path.join(tempdir, 'main.c')] + link_args,
+                 stdout=PIPE, stderr=PIPE)
+    if result.returncode:
+        raise RuntimeError(result.stderr.decode())
+    # The image is written as-is so it needs to include zeroed .bss
+    _objcopy(tempdir, ['--set-section-flags', '.bss=alloc,load,contents'])
+
+
+def _resolve_program(mb_info, bsp):
+    if hasattr(mb_info, 'mb_info'):
+        mb_info = mb_info.mb_info
+    if bsp is None:
+        if mb_info['mbtype'] not in BSPs:
+            raise RuntimeError("Could not find BSP for Microblaze type" +
+                               mb_info['mbtype'])
+        bsp = BSPs[mb_info['mbtype']]
+    return mb_info, bsp
+
+
+def build_program(mb_info, program_text, bsp=None, preprocessed=None,
+                  layout=DEFAULT_LAYOUT, reserve=0, report=None):
+    """Compiles a program without downloading it, keeping `reserve`
+    bytes below the mailbox channels free. The stages of the build and
+    the resulting program are recorded in `report` if provided.
+
+    Returns the cache entry holding the program and whether it was
+    already in the cache.
+
+    """
+    if report is None:
+        report = BuildReport()
+    mb_info, bsp = _resolve_program(mb_info, bsp)
+    if preprocessed is None:
+        with report.stage('preprocess'):
+            preprocessed = preprocess_full(program_text, bsp)
+    modules = [Modules[k] for k in preprocessed.modules]
+    source = '#line 1 "cell_magic"\n' + program_text
+    if layout != DEFAULT_LAYOUT:
+        # The prebuilt BSPs fix the mailbox descriptors at the default
+        # layout so the program brings its own mailbox layer
+        source += '\n#line 1 "mailbox_layout"\n' + layout.c_source()
+    key = _program_key(source, bsp, preprocessed.modules,
+                       preprocessed.headers, layout, reserve)
+    # Processes compiling the same program wait for the first to finish
+    lock_start = time.perf_counter()
+    with program_cache.lock(key):
+        report.stages['lock'] = (report.stages.get('lock', 0.0) +
+                                 time.perf_counter() - lock_start)
+        entry = program_cache.lookup(key)
+        cache_hit = entry is not None
+        if entry is None:
+            with tempfile.TemporaryDirectory() as tempdir:
+                _compile(source, bsp, modules, tempdir, layout, reserve,
+                         report)
+                entry = program_cache.store(key, tempdir, ['a.out', 'a.bin'])
+    report.modules = list(preprocessed.modules)
+    report.headers = list(preprocessed.headers)
+    report.cache_hit = cache_hit
+    report.entry = entry
+    report.read_elf(path.join(entry, 'a.out'), layout.base - reserve,
+                    layout.base)
+    return entry, cache_hit
+
+
+def build_overlay(mb_info, source, kernel, origin, length, bsp=None,
+                  preprocessed=None):
+    """Compiles a program to be loaded at `origin` while the program in
+    the ELF file `kernel` is running, calling into it directly
+
+    Returns the cache entry holding the overlay.
+
+    """
+    mb_info, bsp = _resolve_program(mb_info, bsp)
+    if preprocessed is None:
+        preprocessed = preprocess_full(source, bsp)
+    modules = [Modules[k] for k in preprocessed.modules]
+    key = hash_key(_program_key(source, bsp, preprocessed.modules,
+                                preprocessed.headers, DEFAULT_LAYOUT),
+                   origin, length, hash_file(kernel))
+    with program_cache.lock(key):
+        entry = program_cache.lookup(key)
+        if entry is None:
+            with tempfile.TemporaryDirectory() as tempdir:
+                _compile_overlay(source, bsp, modules, tempdir, kernel,
+                                 origin, length)
+                entry = program_cache.store(key, tempdir, ['a.out', 'a.bin'])
+    return entry
+
+
+def _build_job(job):
+    mb_info, program_text, kwargs = job
+    return build_program(mb_info, program_text, **kwargs)
+
+
+def build_programs(jobs, max_workers=None):
+    """Compiles (mb_info, program_text, kwargs) jobs concurrently in a
+    process pool and returns the result of `build_program` for each
+
+    """
+    jobs = [(_resolve_program(mb_info, kwargs.get('bsp'))[0], text, kwargs)
+            for mb_info, text, kwargs in jobs]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_build_job, jobs))
+
+
+def compile_programs(programs, max_workers=None, **kwargs):
+    """Compiles several programs concurrently and then downloads them
+
+    Parameters
+    ----------
+    programs    : [(MicroblazeHierarchy or mb_info, str)]
+        Microblaze and program text of each program
+    max_workers : int
+        Number of compiler processes, defaults to the number of CPUs
+    kwargs      :
+        Passed on to `MicroblazeProgram`
+
+    Returns
+    -------
+    [MicroblazeProgram]
+        The downloaded programs in the same order
+
+    """
+    programs = list(programs)
+    build_programs([(mb_info, text, kwargs) for mb_info, text in programs],
+                   max_workers)
+    return [MicroblazeProgram(mb_info, text, **kwargs)
+            for mb_info, text in programs]
+
+
+# Granularity at which a new program is compared against the memory
+# of the Microblaze when swapping programs
+_PAGE_SIZE = 256
+_MEMORY_SIZE = 64 * 1024
+
+_elf_header = struct.Struct('<32xI10xHHH')
+_elf_section = struct.Struct('<IIIIII16x')
+_SHT_PROGBITS = 1
+_SHT_NOBITS = 8
+_SHF_WRITE = 1
+_SHF_ALLOC = 2
+
+
+def _elf_sections(elf_file):
+    """Returns the (name, type, flags, address, size) of each section
+    of an ELF file
+
+    """
+    with open(elf_file, 'rb') as f:
+        elf = f.read()
+    shoff, shentsize, shnum, shstrndx = _elf_header.unpack_from(elf)
+    headers = [_elf_section.unpack_from(elf, shoff + i * shentsize)
+               for i in range(shnum)]
+    names = headers[shstrndx][4] if shstrndx < shnum else None
+    sections = []
+    for name, type_, flags, addr, offset, size in headers:
+        if names is not None:
+            end = elf.index(b'\x00', names + name)
+            name = elf[names + name:end].decode()
+        sections.append((name, type_, flags, addr, size))
+    return sections
+
+
+def _readonly_ranges(elf_file):
+    """Returns the (address, size) of each section of an ELF file that
+    is loaded but never written to by the running program
+
+    """
+    return [(addr, size)
+            for name, type_, flags, addr, size in _elf_sections(elf_file)
+            if (type_ == _SHT_PROGBITS and flags & _SHF_ALLOC and
+                not flags & _SHF_WRITE)]
+
+
+def _trusted_pages(elf_file, image_size):
+    """Returns a mask of the pages of a loaded image whose contents stay
+    the same while the program runs
+
+    """
+    pages = np.zeros((image_size + _PAGE_SIZE - 1) // _PAGE_SIZE, dtype=bool)
+    for addr, size in _readonly_ranges(elf_file):
+        # Only pages entirely within a read-only section can be trusted
+        first = (addr + _PAGE_SIZE - 1) // _PAGE_SIZE
+        last = (addr + size) // _PAGE_SIZE
+        pages[first:min(last, len(pages))] = True
+    return pages
+
+
+def _copy_program(entry):
+    """Copies a program out of the cache so it stays available while it
+    is loaded even if the cache entry is evicted. Returns the temporary
+    directory holding the copy.
+
+    """
+    program_dir = tempfile.TemporaryDirectory()
+    for filename in ('a.out', 'a.bin'):
+        shutil.copy(path.join(entry, filename), program_dir.name)
+    return program_dir
+
+
+# Program image, trusted page mask, layout and PL state path last loaded
+# onto each Microblaze keyed by the name of the IP
+_resident = {}
+
 
 class MicroblazeProgram(PynqMicroblaze):
-    def __init__(self, mb_info, program_text, bsp=None):
-        if hasattr(mb_info, 'mb_info'):
-            mb_info = mb_info.mb_info
-        if bsp is None:
-            if mb_info['mbtype'] not in BSPs:
-                raise RuntimeError("Could not find BSP for Microblaze type" +
-                                   mb_info['mbtype'])
-            bsp = BSPs[mb_info['mbtype']]
-
-        modules = dependencies(program_text, bsp)
-        lib_args = []
-        with tempfile.TemporaryDirectory() as tempdir:
-            files = [path.join(tempdir, 'main.c')]
-            args = ['mb-gcc', '-o', path.join(tempdir, 'a.out') ]
-            args.extend(bsp.cflags)
-            args.extend(bsp.sources)
-            for include_path in bsp.include_path:
-                args.append('-I')
-                args.append(include_path)
-            for lib_path in bsp.library_path:
-                lib_args.append('-L')
-                lib_args.append(lib_path)
-            for lib in bsp.libraries:
-                lib_args.append(f'-l{lib}')
-            args.append(f'-Wl,{bsp.linker_script}')
-            args.extend(bsp.ldflags)
-
-            for module in modules:
-                files.extend(module.sources)
-                for include_path in module.include_path:
-                     args.append('-I')
-                     args.append(include_path)
-                for lib_path in module.library_path:
-                     lib_args.append('-L')
-                     lib_args.append(lib_path)
-                for lib in module.libraries:
-                     lib_args.append(f'-l{lib}')
-
-            with open(path.join(tempdir, 'main.c'), 'w') as f:
-                f.write('#line 1 "cell_magic"\n')
-                f.write(program_text)
-            result = run(args + files + lib_args, stdout=PIPE, stderr=PIPE)
-            if result.returncode:
-                raise RuntimeError(result.stderr.decode())
-            shutil.copy(path.join(tempdir, 'a.out'), '/tmp/last.elf')
-            result = run(['mb-objcopy', '-O', 'binary',
-                          path.join(tempdir, 'a.out'),
-                          path.join(tempdir, 'a.bin')],
-                         stderr=PIPE)
-            if result.returncode:
-                print("Objcopy Failed!")
-                print(result.stderr.decode())
-
-            super().__init__(mb_info, path.join(tempdir, 'a.bin'))
-            self.stream = InterruptMBStream(self)
+    def __init__(self, mb_info, program_text, bsp=None, preprocessed=None,
+                 layout=DEFAULT_LAYOUT, reserve=0, report=None):
+        mb_info, bsp = _resolve_program(mb_info, bsp)
+        # The build of the program is described by the report attribute
+        if report is None:
+            report = BuildReport()
+        self.report = report
+        entry, self.cache_hit = build_program(
+            mb_info, program_text, bsp, preprocessed, layout, reserve,
+            report)
+        self._program_dir = _copy_program(entry)
+        entry = self._program_dir.name
+        shutil.copy(path.join(entry, 'a.out'), '/tmp/last.elf')
+
+        with report.stage('download'):
+            super().__init__(mb_info, path.join(entry, 'a.bin'))
+        self._mb_info = mb_info
+        self._bsp = bsp
+        self.entry = entry
+        self.reserve = reserve
+        self.pump = None
+        self._record_resident(entry, layout)
+        self._open_streams(layout)
+
+    def _open_streams(self, layout):
+        self.layout = layout
+        self.stream = InterruptMBStream(
+            self, **layout.stream_args('stdout', 'stdin'))
+        self.read = self.stream.read
+        self.write = self.stream.write
+        self.read_async = self.stream.read_async
+
+    def _record_resident(self, entry, layout):
+        with open(path.join(entry, 'a.bin'), 'rb') as f:
+            image = f.read()
+        _resident[self.ip_name] = (
+            image, _trusted_pages(path.join(entry, 'a.out'), len(image)),
+            layout, path.join(entry, 'a.bin'))
+
+    def load(self, program_text, preprocessed=None, layout=None):
+        """Replaces the running program without a full reset
+
+        Only the pages of memory that differ from the current program
+        are written and the mailbox channels are cleared in place if the
+        layout is unchanged, rather than clearing the whole of memory.
+        Pages which the current program may have modified are always
+        rewritten. If another process has loaded a different program
+        onto the Microblaze since, the whole of memory is rewritten.
+
+        Returns
+        -------
+        int
+            Number of bytes written to the Microblaze
+
+        """
+        if layout is None:
+            layout = self.layout
+        self.report = BuildReport()
+        entry, self.cache_hit = build_program(
+            self._mb_info, program_text, self._bsp, preprocessed, layout,
+            self.reserve, self.report)
+        self._program_dir = _copy_program(entry)
+        entry = self._program_dir.name
+        self.entry = entry
+        shutil.copy(path.join(entry, 'a.out'), '/tmp/last.elf')
+        with open(path.join(entry, 'a.bin'), 'rb') as f:
+            image = f.read()
+        # Writes need to be whole words
+        image += bytes(-len(image) % 4)
+        self.stop_pump()
+        old_image, trusted, old_layout, old_state = _resident.get(
+            self.ip_name, (b'', np.zeros(0, dtype=bool), None, None))
+        PynqMicroblaze.reset(self)
+        # The state is checked and updated in a single request to the PL
+        # server so no other process can load a program in between
+        PL.client_request()
+        try:
+            # The record is only valid if nothing else has been loaded
+            current = old_state == PL._ip_dict[self.ip_name]['state']
+            with self.report.stage('download'):
+                if not current or old_layout != layout:
+                    self.mmio.write(0, _MEMORY_SIZE * b'\x00')
+                    self.mmio.write(0, image)
+                    written = _MEMORY_SIZE + len(image)
+                else:
+                    written = self._write_changed(image, old_image, trusted)
+                    for name, size, direction in layout.channels:
+                        self.mmio.write(layout.offset(name), 8 * b'\x00')
+                        written += 8
+            PL._ip_dict[self.ip_name]['state'] = path.join(entry, 'a.bin')
+        finally:
+            PL.server_update()
+        self.mb_program = path.join(entry, 'a.bin')
+        self._record_resident(entry, layout)
+        if self.interrupt:
+            self.interrupt.clear()
+        self.run()
+        self._open_streams(layout)
+        return written
+
+    def _write_changed(self, image, old_image, trusted):
+        pages = (len(image) + _PAGE_SIZE - 1) // _PAGE_SIZE
+        changed = np.ones(pages, dtype=bool)
+        common = min(len(trusted), pages,
+                     len(old_image) // _PAGE_SIZE, len(image) // _PAGE_SIZE)
+        if common:
+            size = common * _PAGE_SIZE
+            old = np.frombuffer(old_image, dtype=np.uint8, count=size)
+            new = np.frombuffer(image, dtype=np.uint8, count=size)
+            differs = (old != new).reshape(common, _PAGE_SIZE).any(axis=1)
+            changed[:common] = differs | ~trusted[:common]
+        written = 0
+        page = 0
+        # Coalesce runs of changed pages into single writes
+        while page < pages:
+            if not changed[page]:
+                page += 1
+                continue
+            end = page
+            while end < pages and changed[end]:
+                end += 1
+            start = page * _PAGE_SIZE
+            data = image[start:end * _PAGE_SIZE]
+            self.mmio.write(start, data)
+            written += len(data)
+            page = end
+        return written
+
+    def start_pump(self, **kwargs):
+        """Continuously drain stdout in the background, see `StdoutPump`
+        for the arguments. While the pump is running `read` returns the
+        buffered output.
+
+        """
+        if self.pump is None:
+            self.pump = StdoutPump(self.stream, **kwargs)
+            self.pump.start()
+            self.read = self.pump.read
+        return self.pump
+
+    def stop_pump(self):
+        if self.pump is not None:
+            self.pump.stop()
+            self.pump = None
             self.read = self.stream.read
-            self.write = self.stream.write
-            self.read_async = self.stream.read_async
+
+    def pump_stats(self):
+        """Counters of the stdout pump or None if it isn't running
+
+        """
+        if self.pump is None:
+            return None
+        return self.pump.stats()
 
     def reset(self):
+        self.stop_pump()
         PL.client_request()
         PL._ip_dict[self.ip_name]['state'] = None
         PL.server_update()
         super().reset()
-        self.mmio.write(0, (64 * 1024) * b'\x00')
+        self.mmio.write(0, _MEMORY_SIZE * b'\x00')
+        _resident.pop(self.ip_name, None)
@@ -3,7 +3,29 @@
 #include <string.h>
 #include <stdarg.h>
 
-static const char printf_command = 1;
+// Must match the command numbers in rpc.py
+#define PRINTF_INLINE 1
+#define PRINTF_DEFINE 2
+#define PRINTF_INTERNED 3
+
+#ifndef PYPRINTF_MAX_FORMATS
+#define PYPRINTF_MAX_FORMATS 32
+#endif
+
+#ifndef PYPRINTF_MAX_ARGS
+#define PYPRINTF_MAX_ARGS 256
+#endif
+
+// Formats are sent once and then referred to by their index. They are
+// matched on both address and contents in case the format isn't a
+// literal and the memory is reused.
+static const char* formats[PYPRINTF_MAX_FORMATS];
+static unsigned int format_hashes[PYPRINTF_MAX_FORMATS];
+static int num_formats;
+
+// Command byte, 16-bit id or length, 16-bit argument length and the
+// packed arguments so a call is a single write
+static unsigned char message[5 + PYPRINTF_MAX_ARGS];
 
 void complete_write(int fd, const char* data, unsigned int length) {
     while (length > 0) {
@@ -13,34 +35,112 @@ void complete_write(int fd, const char* data, unsigned int length) {
     }
 }
 
-void pyprintf(const char* format, ...) {
-    unsigned short len = strlen(format);
-    complete_write(3, &printf_command, 1);
-    complete_write(3, &len, 2);
-    complete_write(3, format, len);
-    int in_special = 0;
-    va_list args;
-    va_start(args, format);
+static int pack(unsigned int* offset, const void* data, unsigned int length) {
+    if (*offset + length > sizeof(message)) return 0;
+    memcpy(message + *offset, data, length);
+    *offset += length;
+    return 1;
+}
+
+// Walks the format packing each argument after the header and returns a
+// hash of the format. The host decodes the arguments with the same rules.
+static unsigned int pack_args(const char* format, va_list args,
+                              unsigned int* offset) {
+    unsigned int hash = 2166136261u;
     while (*format != '\0') {
-        if (in_special) {
-            switch (*format) {
-            case 'd':
-            {
+        hash = (hash ^ (unsigned char)*format) * 16777619u;
+        if (*format++ != '%') continue;
+        while (*format && strchr("-+ #0", *format)) {
+            hash = (hash ^ (unsigned char)*format) * 16777619u;
+            ++format;
+        }
+        while (*format && strchr("0123456789.*hlLzjt", *format)) {
+            if (*format == '*') {
                 int val = va_arg(args, int);
-                complete_write(3, &val, sizeof(val));
+                pack(offset, &val, sizeof(val));
             }
-                break;
-            case 'f':
-            {
-                float val = (double)va_arg(args, double);
-                complete_write(3, &val, sizeof(val));
-            }
-                break;
+            hash = (hash ^ (unsigned char)*format) * 16777619u;
+            ++format;
+        }
+        if (*format == '\0') break;
+        int is_long_long = format[-1] == 'l' && format[-2] == 'l';
+        hash = (hash ^ (unsigned char)*format) * 16777619u;
+        switch (*format++) {
+        case 'd': case 'i': case 'c':
+        case 'u': case 'o': case 'x': case 'X':
+            if (is_long_long) {
+                long long val = va_arg(args, long long);
+                pack(offset, &val, sizeof(val));
+            } else {
+                int val = va_arg(args, int);
+                pack(offset, &val, sizeof(val));
             }
-            in_special = 0;
-        } else if (*format == '%') {
-            in_special = 1;
+            break;
+        case 'p':
+        {
+            void* val = va_arg(args, void*);
+            pack(offset, &val, sizeof(val));
         }
-        ++format;
+            break;
+        case 'f': case 'F': case 'e': case 'E': case 'g': case 'G':
+        {
+            float val = (float)va_arg(args, double);
+            pack(offset, &val, sizeof(val));
+        }
+            break;
+        case 's':
+        {
+            const char* val = va_arg(args, const char*);
+            unsigned int space = sizeof(message) - *offset;
+            unsigned short len = strlen(val);
+            // Truncate strings which don't fit
+            if (space < 2) break;
+            if (len > space - 2) len = space - 2;
+            pack(offset, &len, sizeof(len));
+            pack(offset, val, len);
+        }
+            break;
+        }
+    }
+    return hash;
+}
+
+void pyprintf(const char* format, ...) {
+    unsigned int offset = 5;
+    va_list args;
+    va_start(args, format);
+    unsigned int hash = pack_args(format, args, &offset);
+    va_end(args);
+    unsigned short arg_len = offset - 5;
+
+    unsigned short id;
+    for (id = 0; id < num_formats; ++id) {
+        if (formats[id] == format && format_hashes[id] == hash) break;
+    }
+    if (id == num_formats && num_formats < PYPRINTF_MAX_FORMATS) {
+        unsigned char header[5] = {PRINTF_DEFINE};
+        unsigned short len = strlen(format);
+        memcpy(header + 1, &id, 2);
+        memcpy(header + 3, &len, 2);
+        complete_write(3, (const char*)header, 5);
+        complete_write(3, format, len);
+        formats[id] = format;
+        format_hashes[id] = hash;
+        ++num_formats;
+    }
+    if (id < num_formats) {
+        message[0] = PRINTF_INTERNED;
+        memcpy(message + 1, &id, 2);
+        memcpy(message + 3, &arg_len, 2);
+        complete_write(3, (const char*)message, offset);
+    } else {
+        // Table is full so send the format with every call
+        unsigned short len = strlen(format);
+        message[0] = PRINTF_INLINE;
+        memcpy(message + 1, &len, 2);
+        complete_write(3, (const char*)message, 3);
+        complete_write(3, format, len);
+        complete_write(3, (const char*)&arg_len, 2);
+        complete_write(3, (const char*)message + 5, arg_len);
     }
 }
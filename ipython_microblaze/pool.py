@@ -0,0 +1,190 @@
+#   Copyright (c) 2016, Xilinx, Inc.
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+from .rpc import MicroblazeRPC
+
+__author__ = "Peter Ogden"
+__copyright__ = "Copyright 2017, Xilinx"
+__email__ = "ogden@xilinx.com"
+
+
+class _PoolFunction:
+    """Dispatches calls of one RPC function across the pool
+
+    """
+    def __init__(self, pool, name):
+        self._pool = pool
+        self._name = name
+
+    def submit(self, *args, member=None):
+        """Calls the function on `member`, or the next member in round
+        robin order, and returns a `concurrent.futures.Future`
+
+        """
+        return self._pool._submit(self._name, args, member)
+
+    def __call__(self, *args, member=None):
+        return self.submit(*args, member=member).result()
+
+    def broadcast(self, *args):
+        """Calls the function with the same arguments on every member
+        and returns the results in member order
+
+        """
+        futures = [self._pool._submit(self._name, args, i)
+                   for i in range(len(self._pool.members))]
+        return [f.result() for f in futures]
+
+    def map(self, arg_list):
+        """Spreads calls with each tuple of arguments in `arg_list`
+        across the members and returns the results in order
+
+        """
+        futures = [self._pool._submit(self._name, tuple(args), None)
+                   for args in arg_list]
+        return [f.result() for f in futures]
+
+
+class RPCPool:
+    """Runs the same RPC program on several Microblazes
+
+    Each function of the program is available on the pool and can be
+    called on the next member in round robin order, on a specific
+    member, or on every member. Calls to different members run
+    concurrently while calls to the same member are made in order.
+
+    Attributes
+    ----------
+    members : [MicroblazeRPC]
+        RPC instance for each Microblaze in the pool
+    names   : [str]
+        Name of each member, used to select members by affinity
+
+    """
+    def __init__(self, rpcs, names=None):
+        """Create a pool from existing RPC instances running the same
+        program
+
+        Parameters
+        ----------
+        rpcs  : [MicroblazeRPC]
+            RPC instances to dispatch calls to
+        names : [str]
+            Names to refer to the members by, defaults to their indices
+
+        """
+        if not rpcs:
+            raise RuntimeError("An RPC pool needs at least one member")
+        self.members = list(rpcs)
+        if names is None:
+            names = [str(i) for i in range(len(self.members))]
+        if len(names) != len(self.members):
+            raise RuntimeError("Each member of the pool needs one name")
+        self.names = list(names)
+        self._functions = set(self.members[0].visitor.functions)
+        for rpc in self.members[1:]:
+            if set(rpc.visitor.functions) != self._functions:
+                raise RuntimeError(
+                    "Members of a pool must expose the same functions")
+        self._executors = [ThreadPoolExecutor(max_workers=1)
+                           for _ in self.members]
+        self._next = itertools.cycle(range(len(self.members)))
+
+    @classmethod
+    def create(cls, iops, *args, names=None, rpc_class=MicroblazeRPC,
+               **kwargs):
+        """Load the same program onto each Microblaze in `iops`
+
+        Parameters
+        ----------
+        iops      : [MicroblazeHierarchy or mb_info]
+            Microblazes to run the program on
+        args      :
+            Passed on to `rpc_class` after the Microblaze, typically the
+            program text for `MicroblazeRPC`
+        names     : [str]
+            Names to refer to the members by
+        rpc_class : type
+            Class of the RPC instance created for each Microblaze
+        kwargs    :
+            Passed on to `rpc_class`
+
+        """
+        return cls([rpc_class(iop, *args, **kwargs) for iop in iops], names)
+
+    def _index(self, member):
+        if member is None:
+            return next(self._next)
+        if isinstance(member, int):
+            return member
+        return self.names.index(member)
+
+    def _submit(self, name, args, member):
+        index = self._index(member)
+        function = getattr(self.members[index], name)
+        return self._executors[index].submit(function, *args)
+
+    def __getitem__(self, member):
+        """Returns the RPC instance for a member selected by index or
+        name
+
+        """
+        return self.members[self._index(member)]
+
+    def __len__(self):
+        return len(self.members)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name in self._functions:
+            return _PoolFunction(self, name)
+        # Constants are the same for every member
+        return getattr(self.members[0], name)
+
+    def fence(self):
+        """Waits until every member has completed every call sent to it
+
+        """
+        futures = [e.submit(rpc.fence)
+                   for e, rpc in zip(self._executors, self.members)]
+        for f in futures:
+            f.result()
+
+    def reset(self):
+        """Reset and free every Microblaze in the pool
+
+        """
+        for executor in self._executors:
+            executor.shutdown()
+        for rpc in self.members:
+            rpc.reset()
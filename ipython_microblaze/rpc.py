@@ -1,19 +1,52 @@
+import asyncio
+import collections
+import numpy as np
 import pycparser
 import struct
 import functools
 import itertools
+import pickle
+import re
+import tempfile
+import time
+import weakref
+from concurrent.futures import ProcessPoolExecutor
 from pycparser import c_ast
 from pycparser import c_generator
 from copy import deepcopy
-
-from .compile import preprocess
-from .streams import SimpleMBStream
+from os import path
+
+from .cache import CACHE_DIR
+from .cache import FileCache
+from .cache import hash_file
+from .cache import hash_key
+from .compile import BuildReport
+from .compile import build_program
+from .compile import build_overlay
+from .compile import preprocess_full
+from .stats import CallTimeline
+from .stats import RPCStats
+from .streams import DEFAULT_LAYOUT
+from .streams import InterruptMBStream
 from . import MicroblazeProgram
 
 # Use a global parser and generator
 _parser = pycparser.CParser()
 _generator = c_generator.CGenerator()
 
+# Parsed interfaces and generated mains are cached on disk so that
+# the standard RPC objects don't need the headers parsing again
+parse_cache = FileCache(path.join(CACHE_DIR, 'rpc'),
+                        max_size=16 * 1024 * 1024)
+
+
+class _Struct(struct.Struct):
+    """struct.Struct that can be pickled into the parse cache
+
+    """
+    def __reduce__(self):
+        return (_Struct, (self.format,))
+
 # First we define a series of classes to represent types
 # Each class is responsible for one particular type of C
 # types
@@ -23,12 +56,15 @@ class StructWrapper:
 
     """
     def __init__(self, struct_string, type_):
-        self._struct = struct.Struct(struct_string)
+        self._struct = _Struct(struct_string)
         self.typedefname = None
         self._type = type_
     
     def param_encode(self, old_val):
         return self._struct.pack(old_val)
+
+    def param_data(self, old_val):
+        return b''
     
     def param_decode(self, old_val, stream):
         pass
@@ -50,11 +86,14 @@ class VoidPointerWrapper:
     def __init__(self, type_):
         self._type = type_
         self.typedefname = None
-        self._ptrstruct = struct.Struct('I')
+        self._ptrstruct = _Struct('I')
 
     def param_encode(self, old_val):
         return self._ptrstruct.pack(old_val.physical_address)
 
+    def param_data(self, old_val):
+        return b''
+
     def param_decode(self, old_val, stream):
         pass
 
@@ -91,20 +130,60 @@ class VoidPointerWrapper:
     def post_argument(self, name):
         return []
 
+# Element types of arrays as laid out in microblaze memory
+_struct_dtypes = {
+    'b': np.dtype('i1'),
+    'B': np.dtype('u1'),
+    'h': np.dtype('<i2'),
+    'H': np.dtype('<u2'),
+    'l': np.dtype('<i4'),
+    'L': np.dtype('<u4'),
+    'f': np.dtype('<f4'),
+}
+
+def _as_array(val, dtype):
+    """ Views bytes-like objects, NumPy arrays and sequences as an
+    array of `dtype`, only copying if a conversion is needed
+
+    """
+    if isinstance(val, memoryview):
+        val = np.asarray(val)
+    elif isinstance(val, (bytes, bytearray)):
+        val = np.frombuffer(val, dtype=np.uint8)
+    return np.asarray(val).astype(dtype, copy=False)
+
+def _update_array(old_val, new_val):
+    """ Copies `new_val` into `old_val` in place
+
+    """
+    if isinstance(old_val, bytearray) and new_val.itemsize == 1:
+        old_val[:] = new_val.tobytes()
+        return
+    if isinstance(old_val, (bytearray, memoryview)):
+        old_val = np.asarray(memoryview(old_val))
+    if isinstance(old_val, np.ndarray):
+        np.copyto(old_val, new_val.reshape(old_val.shape), casting='unsafe')
+    else:
+        old_val[:] = new_val.tolist()
+
 class ConstPointerWrapper:
     """ Wrapper for const char pointers, transfers data in only
-    one direction.
+    one direction. Accepts sequences, bytes-like objects and
+    NumPy arrays.
 
     """
     def __init__(self, type_, struct_string):
-        self._lenstruct = struct.Struct('h')
+        self._lenstruct = _Struct('h')
         self._struct_string = struct_string
+        self._dtype = _struct_dtypes[struct_string]
         self.typedefname = None
         self._type = type_
 
     def param_encode(self, old_val):
-        packed = struct.pack(self._struct_string * len(old_val), *old_val)
-        return self._lenstruct.pack(len(old_val)) + packed
+        return self._lenstruct.pack(np.size(old_val))
+
+    def param_data(self, old_val):
+        return _as_array(old_val, self._dtype).tobytes()
     
     def param_decode(self, old_val, stream):
         pass
@@ -120,10 +199,9 @@ class ConstPointerWrapper:
                 c_ast.TypeDecl(f'{name}_len', [], 
                                c_ast.IdentifierType(['unsigned', 'short']))))
         commands.append(_generate_read(f'{name}_len'))
-        commands.append(_generate_arraydecl(name,
-                                                  self._type,
-                                                  c_ast.ID(f'{name}_len')))
-        commands.append(_generate_read(name, address=False))
+        commands.append(_generate_bufferdecl(name, self._type,
+                                             _generate_array_size(name)))
+        commands.append(_generate_stream_read(name))
         return commands
 
     def post_argument(self, name):
@@ -132,25 +210,30 @@ class ConstPointerWrapper:
 
 class PointerWrapper:
     """ Wrapper for non-const char pointers that retrieves any
-    data modified by the called function.
+    data modified by the called function. NumPy arrays, bytearrays
+    and writable memoryviews are updated in place.
 
     """
     def __init__(self, type_, struct_string):
-        self._lenstruct = struct.Struct('h')
+        self._lenstruct = _Struct('h')
         self._struct_string = struct_string
+        self._dtype = _struct_dtypes[struct_string]
         self.typedefname = None
         self._type = type_
         
     def param_encode(self, old_val):
-        packed = struct.pack(self._struct_string * len(old_val), *old_val)
-        return self._lenstruct.pack(len(old_val)) + packed
+        return self._lenstruct.pack(np.size(old_val))
+
+    def param_data(self, old_val):
+        return _as_array(old_val, self._dtype).tobytes()
     
     def param_decode(self, old_val, stream):
         data = stream.read(self._lenstruct.size)
         length = self._lenstruct.unpack(data)[0]
-        assert(length == len(old_val))
-        data = stream.read(length * struct.calcsize(self._struct_string))
-        old_val[:] = struct.unpack(self._struct_string * len(old_val), data)
+        data = stream.read(length * self._dtype.itemsize)
+        new_val = np.frombuffer(data, dtype=self._dtype)
+        assert(new_val.size == np.size(old_val))
+        _update_array(old_val, new_val)
     
     def return_decode(self, stream):
         raise RuntimeError("Cannot use a T* decoder as a return value")
@@ -163,16 +246,16 @@ class PointerWrapper:
                 c_ast.TypeDecl(f'{name}_len', [], 
                                c_ast.IdentifierType(['unsigned', 'short']))))
         commands.append(_generate_read(f'{name}_len'))
-        commands.append(_generate_arraydecl(name,
-                                                  self._type,
-                                                  c_ast.ID(f'{name}_len')))
-        commands.append(_generate_read(name, address=False))
+        commands.append(_generate_bufferdecl(name, self._type,
+                                             _generate_array_size(name)))
+        commands.append(_generate_stream_read(name))
         return commands
 
     def post_argument(self, name):
         commands = []
         commands.append(_generate_write(f'{name}_len'))
-        commands.append(_generate_write(name, address=False))
+        commands.append(_generate_write(name, address=False,
+                                        size=_generate_array_size(name)))
         return commands
 
 
@@ -185,6 +268,9 @@ class VoidWrapper:
         
     def param_encode(self, old_val):
         return b''
+
+    def param_data(self, old_val):
+        return b''
     
     def param_decode(self, old_val, stream):
         pass
@@ -281,18 +367,37 @@ def _generate_read(name, size=None, address=True):
         c_ast.ExprList([target,
                         size]))
 
-def _generate_write(name, address=True):
-    """ Helper function generate write functions
+def _generate_stream_read(name):
+    """ Helper function to generate reads of array data which
+    follows the request rather than being part of it
 
     """
+    return c_ast.FuncCall(
+        c_ast.ID('_rpc_read_stream'),
+        c_ast.ExprList([c_ast.ID(name), _generate_array_size(name)]))
+
+def _generate_write(name, address=True, size=None):
+    """ Helper function generate write functions. size
+    should be an AST fragment
+
+    """
+    if size is None:
+        size = c_ast.UnaryOp('sizeof', c_ast.ID(name))
     if address:
         target = c_ast.UnaryOp('&', c_ast.ID(name))
     else:
         target = c_ast.ID(name)
     return c_ast.FuncCall(
         c_ast.ID('_rpc_write'),
-        c_ast.ExprList([target,
-                        c_ast.UnaryOp('sizeof', c_ast.ID(name))]))
+        c_ast.ExprList([target, size]))
+
+def _generate_array_size(name):
+    """ Size in bytes of the array `name` with length `name_len`
+
+    """
+    return c_ast.BinaryOp(
+        '*', c_ast.ID(f'{name}_len'),
+        c_ast.UnaryOp('sizeof', c_ast.UnaryOp('*', c_ast.ID(name))))
 
 def _generate_decl(name, decl):
     """ Generates a new declaration with a difference name
@@ -302,14 +407,16 @@ def _generate_decl(name, decl):
     typedecl = c_ast.TypeDecl(name, [], decl.type)
     return c_ast.Decl(name, [], [], [], typedecl, [], [])
 
-def _generate_arraydecl(name, decl, length):
-    """ Generates a new declaration with an array type
-    base on an existing declaration
+def _generate_bufferdecl(name, decl, size):
+    """ Generates a new pointer declaration based on an existing
+    pointer declaration, pointing to `size` bytes allocated from
+    the RPC arena
 
     """
-    typedecl = c_ast.TypeDecl(name, [], decl.type)
-    arraydecl = c_ast.ArrayDecl(typedecl, length, [])
-    return c_ast.Decl(name, [], [], [], arraydecl, [], [])
+    typedecl = c_ast.TypeDecl(name, [], decl.type.type)
+    ptrdecl = c_ast.PtrDecl([], typedecl)
+    alloc = c_ast.FuncCall(c_ast.ID('_rpc_alloc'), c_ast.ExprList([size]))
+    return c_ast.Decl(name, [], [], [], ptrdecl, alloc, [])
 
 class FuncAdapter:
     """Provides the C and Python interfaces for a function declaration
@@ -377,6 +484,13 @@ class FuncAdapter:
                 self.arg_interfaces, args
             )]
         )
+
+    def pack_data(self, *args):
+        """Returns the array data of the provided arguments which
+        is streamed after the request
+
+        """
+        return [f.param_data(a) for f, a in zip(self.arg_interfaces, args)]
     
     def receive_response(self, stream, *args):
         """Reads the response stream, updates arguments and
@@ -447,84 +561,365 @@ class FuncDefVisitor(pycparser.c_ast.NodeVisitor):
             cur_index += 1
         self.enums.append(enum)
             
-def _build_case(functions):
-    """ Builds the switch statement that will form the foundation
-    of the RPC handler
-
-    """
-    cases = []
-    for i, func in enumerate(functions.values()):
-        case = c_ast.Case(
-            c_ast.Constant('int', f'{i}'),
-            [
-                func.call_ast,
-                c_ast.Break()
-            ])
-        cases.append(case)
-    return c_ast.Switch(
-        c_ast.ID('command'),
-        c_ast.Compound(cases)
-    )
+def _void_function_decl(name, storage=[]):
+    """ Declaration of a `void name(void)` function
 
-def _build_handle_function(functions):
-    """ Wraps the switch statement in a function definition
+    """
+    void_params = c_ast.ParamList([
+        c_ast.Typename(None, [], c_ast.TypeDecl(
+            None, [], c_ast.IdentifierType(['void'])))
+    ])
+    funcdecl = c_ast.FuncDecl(void_params,
+        c_ast.TypeDecl(name, [], c_ast.IdentifierType(['void'])))
+    return c_ast.Decl(name, [], storage, [], funcdecl, None, None)
+
+def _build_call_functions(functions):
+    """ Wraps the call of each function in its own static function
+    so they can be dispatched through a table
+
+    """
+    return [c_ast.FuncDef(_void_function_decl(f'_rpc_call_{i}', ['static']),
+                          None, func.call_ast)
+            for i, func in enumerate(functions.values())]
+
+def _build_table(functions, overlay_slots=0):
+    """ Builds the table of call functions indexed by command. The
+    table is writable if it has slots for functions added later
+
+    """
+    void_params = c_ast.ParamList([
+        c_ast.Typename(None, [], c_ast.TypeDecl(
+            None, [], c_ast.IdentifierType(['void'])))
+    ])
+    entry_type = c_ast.PtrDecl([] if overlay_slots else ['const'],
+        c_ast.FuncDecl(void_params, c_ast.TypeDecl(
+            '_rpc_table', [], c_ast.IdentifierType(['void']))))
+    size = None
+    if overlay_slots:
+        size = c_ast.Constant('int', f'{len(functions) + overlay_slots}')
+    return c_ast.Decl(
+        '_rpc_table', [], ['static'], [],
+        c_ast.ArrayDecl(entry_type, size, []),
+        c_ast.InitList([c_ast.ID(f'_rpc_call_{i}')
+                        for i in range(len(functions))]),
+        None)
+
+# Command index reserved for fence requests
+_FENCE_COMMAND = -1
+
+# Command index reserved for setting an entry of the function table
+_REGISTER_COMMAND = -2
+_register_args = _Struct('iI')
+
+# Set in the length of a request to have the interrupt raised with the
+# response
+_NOTIFY_FLAG = 0x40000000
+
+# Size of the buffer the microblaze reads the fixed size part of a
+# request into
+_RPC_BUFFER_SIZE = 1024
+
+def _build_handle_function(functions, overlay_slots=0, profile=False):
+    """ Builds the RPC handler which reads a framed request in one go
+    and dispatches it through the function table, timestamping each
+    call if `profile` is set
 
     """
-    case_statement = _build_case(functions)
     available_check = c_ast.If(
         c_ast.BinaryOp('<',
             c_ast.FuncCall(
                 c_ast.ID('mailbox_available'),
                 c_ast.ExprList([c_ast.Constant('int', '2')])
             ),
-            c_ast.Constant('int', '4')
+            c_ast.UnaryOp('sizeof', c_ast.ID('header'))
         ),
         c_ast.Return(None),
         None
     )
-    handle_decl = c_ast.FuncDecl(None, 
-        c_ast.TypeDecl('_handle_events', [],
-            c_ast.IdentifierType(['void'])),
-    )
-    command_decl = c_ast.Decl('command', [], [], [],
-                             c_ast.TypeDecl('command', [], c_ast.IdentifierType(['int'])),
-                              [], [])
-    command_read = _generate_read('command')
-    body = c_ast.Compound([available_check,
-                           command_decl,
-                           command_read,
-                           case_statement])
-    return c_ast.FuncDef(handle_decl, [], body)
-
-def _build_main(program_text, functions):
+    header_decl = c_ast.Decl('header', [], [], [],
+        c_ast.ArrayDecl(
+            c_ast.TypeDecl('header', [], c_ast.IdentifierType(['int'])),
+            c_ast.Constant('int', '2'), []),
+        None, None)
+    command = c_ast.ArrayRef(c_ast.ID('header'), c_ast.Constant('int', '0'))
+    length = c_ast.ArrayRef(c_ast.ID('header'), c_ast.Constant('int', '1'))
+    notify_flag = c_ast.Constant('int', hex(_NOTIFY_FLAG))
+    body = [
+        header_decl,
+        available_check,
+        c_ast.FuncCall(c_ast.ID('_rpc_receive'), c_ast.ExprList([
+            c_ast.ID('header'), c_ast.UnaryOp('sizeof', c_ast.ID('header'))
+        ])),
+    ]
+    if profile:
+        body.append(c_ast.FuncCall(c_ast.ID('_rpc_profile_receive'),
+                                   c_ast.ExprList([])))
+    body += [
+        # The host sets a flag in the length when it waits on the interrupt
+        c_ast.Assignment('=', c_ast.ID('_rpc_notify'),
+                         c_ast.BinaryOp('&', length, notify_flag)),
+        c_ast.Assignment('&=', length, c_ast.UnaryOp('~', notify_flag)),
+        c_ast.FuncCall(c_ast.ID('_rpc_receive'), c_ast.ExprList([
+            c_ast.ID('_rpc_buffer'), length
+        ])),
+        c_ast.Assignment('=', c_ast.ID('_rpc_arena_used'),
+                         c_ast.Constant('int', '0')),
+    ]
+    # A fence is acknowledged once every earlier request has completed
+    dispatch = c_ast.If(
+        c_ast.BinaryOp('==', command,
+                       c_ast.Constant('int', f'{_FENCE_COMMAND}')),
+        _generate_write('return_command'),
+        None)
+    if overlay_slots:
+        dispatch = c_ast.If(
+            c_ast.BinaryOp('==', command,
+                           c_ast.Constant('int', f'{_REGISTER_COMMAND}')),
+            c_ast.FuncCall(c_ast.ID('_rpc_register'), c_ast.ExprList([])),
+            dispatch)
+    if functions or overlay_slots:
+        table_size = len(functions) + overlay_slots
+        valid_command = c_ast.BinaryOp('&&',
+            c_ast.BinaryOp('>=', command, c_ast.Constant('int', '0')),
+            c_ast.BinaryOp('<', command,
+                           c_ast.Constant('int', f'{table_size}')))
+        if overlay_slots:
+            # Slots for added functions are empty until registered
+            valid_command = c_ast.BinaryOp('&&', valid_command,
+                c_ast.ArrayRef(c_ast.ID('_rpc_table'), command))
+        call = c_ast.FuncCall(c_ast.ArrayRef(c_ast.ID('_rpc_table'), command),
+                              c_ast.ExprList([]))
+        if profile:
+            call = c_ast.Compound([
+                c_ast.FuncCall(c_ast.ID('_rpc_profile_start'),
+                               c_ast.ExprList([])),
+                call,
+                c_ast.FuncCall(c_ast.ID('_rpc_profile_end'),
+                               c_ast.ExprList([])),
+            ])
+        dispatch = c_ast.If(valid_command, call, dispatch)
+    body.append(dispatch)
+    return c_ast.FuncDef(_void_function_decl('_handle_events'), None,
+                         c_ast.Compound(body))
+
+# Headers needed by the generated main in addition to the user's program
+_main_includes = """
+#include <unistd.h>
+#include <string.h>
+#include <mailbox_io.h>
+#include <intrgpio.h>
+"""
+
+# Default number of bytes reserved on the microblaze for array arguments
+DEFAULT_ARENA_SIZE = 4096
+
+def _arena_needed(functions, arena_size, overlay_slots=0):
+    """ Returns the size of the arena to reserve, which is none unless
+    a function has array arguments or functions can be added later
+
+    """
+    if overlay_slots:
+        return arena_size
+    for function in functions.values():
+        for interface in function.arg_interfaces:
+            if isinstance(interface, (ConstPointerWrapper, PointerWrapper)):
+                return arena_size
+    return 0
+
+# Default seconds to spin waiting for a response before sleeping and the
+# longest interval to sleep for between checks
+DEFAULT_SPIN_TIME = 0.0001
+DEFAULT_SLEEP_TIME = 0.001
+_MIN_SLEEP = 0.00001
+
+# Default timer and channel counting cycles when profiling and the
+# frequency they count at
+DEFAULT_PROFILE_TIMER = (0, 1)
+DEFAULT_TIMER_FREQUENCY = 100000000
+
+# Cycle counts of the receipt of a request, the start of the call, the
+# start of the response and the end of the response. They are appended
+# to every response when profiling.
+_profile_source = R"""
+    #include <xtmrctr.h>
+
+    static UINTPTR _rpc_timer_base;
+    static unsigned int _rpc_profile[4];
+    static int _rpc_responded;
+
+    static unsigned int _rpc_cycles(void) {
+        return XTmrCtr_ReadReg(_rpc_timer_base, RPC_PROFILE_CHANNEL,
+                               XTC_TCR_OFFSET);
+    }
+
+    /* Free-running up counter which wraps every 2^32 cycles */
+    static void _rpc_profile_init(void) {
+        _rpc_timer_base =
+            XTmrCtr_LookupConfig(RPC_PROFILE_TIMER)->BaseAddress;
+        XTmrCtr_WriteReg(_rpc_timer_base, RPC_PROFILE_CHANNEL,
+                         XTC_TLR_OFFSET, 0);
+        XTmrCtr_WriteReg(_rpc_timer_base, RPC_PROFILE_CHANNEL,
+                         XTC_TCSR_OFFSET, XTC_CSR_LOAD_MASK);
+        XTmrCtr_WriteReg(_rpc_timer_base, RPC_PROFILE_CHANNEL,
+                         XTC_TCSR_OFFSET,
+                         XTC_CSR_ENABLE_TMR_MASK | XTC_CSR_AUTO_RELOAD_MASK);
+    }
+
+    static void _rpc_profile_receive(void) {
+        _rpc_profile[0] = _rpc_cycles();
+    }
+
+    static void _rpc_profile_start(void) {
+        _rpc_responded = 0;
+        _rpc_profile[1] = _rpc_cycles();
+    }
+"""
+
+_profile_end_source = R"""
+    static void _rpc_profile_end(void) {
+        if (_rpc_responded) {
+            _rpc_profile[3] = _rpc_cycles();
+            _rpc_write(_rpc_profile, sizeof(_rpc_profile));
+        }
+    }
+"""
+
+# Declarations of the server's helpers for functions added to a
+# running server
+_overlay_prelude = """
+extern const char return_command;
+void _rpc_read(void* data, int size);
+void _rpc_read_stream(void* data, int size);
+void* _rpc_alloc(int size);
+void _rpc_write(const void* data, int size);
+"""
+
+def _build_main(program_text, functions, arena_size=DEFAULT_ARENA_SIZE,
+                overlay_slots=0, profile=None):
     sections = []
+    sections.append(_main_includes)
+    arena_size = _arena_needed(functions, arena_size, overlay_slots)
+    sections.append(f'#define RPC_ARENA_SIZE {arena_size}')
+    sections.append(f'#define RPC_BUFFER_SIZE {_RPC_BUFFER_SIZE}')
+    # Functions added later link against the helpers so they need to
+    # be visible in the symbol table
+    if overlay_slots:
+        sections.append('#define RPC_EXPORT')
+    else:
+        sections.append('#define RPC_EXPORT static')
+    if profile:
+        sections.append('#define RPC_PROFILE')
+        sections.append(f'#define RPC_PROFILE_TIMER {profile[0]}')
+        sections.append(f'#define RPC_PROFILE_CHANNEL {profile[1]}')
+        sections.append(_profile_source)
     sections.append(R"""
-    #include <unistd.h>
-    #include <mailbox_io.h>
-    static const char return_command = 0;
+    RPC_EXPORT const char return_command = 0;
+
+    /* Fixed size part of the request currently being handled */
+    static unsigned char _rpc_buffer[RPC_BUFFER_SIZE];
+    static int _rpc_offset;
+
+    /* Array arguments are allocated from a static arena rather than
+       the stack and are reset for each request */
+    #if RPC_ARENA_SIZE > 0
+    static int _rpc_arena[RPC_ARENA_SIZE / sizeof(int)];
+    #endif
+    static int _rpc_arena_used;
 
-    static void _rpc_read(void* data, int size) {
+    /* Whether the host is waiting on the interrupt for the response */
+    static int _rpc_notify;
+
+    static void _rpc_receive(void* data, int size) {
+        if (size > sizeof(_rpc_buffer)) {
+            size = sizeof(_rpc_buffer);
+        }
         int available = mailbox_available(2);
         while (available < size) {
             available = mailbox_available(2);
         }
         read(2, data, size);
+        _rpc_offset = 0;
     }
 
-    static void _rpc_write(const void* data, int size) {
-        int available = mailbox_available(3);
-        while (available < size) {
-            available = mailbox_available(3);
+    RPC_EXPORT void _rpc_read(void* data, int size) {
+        memcpy(data, _rpc_buffer + _rpc_offset, size);
+        _rpc_offset += size;
+    }
+
+    #if RPC_ARENA_SIZE > 0
+    RPC_EXPORT void* _rpc_alloc(int size) {
+        void* ptr = (char*)_rpc_arena + _rpc_arena_used;
+        _rpc_arena_used += (size + 3) & ~3;
+        return ptr;
+    }
+    #endif
+
+    /* Array data follows the request and may be larger than the
+       channel so it is consumed as it arrives */
+    RPC_EXPORT void _rpc_read_stream(void* data, int size) {
+        char* dest = data;
+        while (size > 0) {
+            int available = mailbox_available(2);
+            if (available > 0) {
+                int chunk = available < size ? available : size;
+                read(2, dest, chunk);
+                dest += chunk;
+                size -= chunk;
+            }
+        }
+    }
+
+    RPC_EXPORT void _rpc_write(const void* data, int size) {
+        const char* src = data;
+    #ifdef RPC_PROFILE
+        if (data == &return_command) {
+            /* The call has finished once it starts responding */
+            _rpc_profile[2] = _rpc_cycles();
+            _rpc_responded = 1;
+        }
+    #endif
+        while (size > 0) {
+            int available = mailbox_available(3);
+            if (available > 0) {
+                int chunk = available < size ? available : size;
+                write(3, src, chunk);
+                src += chunk;
+                size -= chunk;
+            }
+        }
+        if (data == &return_command && _rpc_notify) {
+            /* Wake up the host waiting asynchronously for the response */
+            IntrGpio_RaiseInterrupt(0);
         }
-        write(3, data, size);
     }
     """)
     
     sections.append(program_text)
-    sections.append(_generator.visit(_build_handle_function(functions)))
+    for call_function in _build_call_functions(functions):
+        sections.append(_generator.visit(call_function))
+    if functions or overlay_slots:
+        sections.append(
+            _generator.visit(_build_table(functions, overlay_slots)) + ';')
+    if overlay_slots:
+        sections.append(R"""
+    static void _rpc_register(void) {
+        int entry[2];
+        _rpc_read(entry, sizeof(entry));
+        if (entry[0] >= %d && entry[0] < %d) {
+            _rpc_table[entry[0]] = (void (*)(void))entry[1];
+        }
+    }
+    """ % (len(functions), len(functions) + overlay_slots))
+    if profile:
+        sections.append(_profile_end_source)
+    sections.append(_generator.visit(
+        _build_handle_function(functions, overlay_slots, bool(profile))))
     
     sections.append(R"""
     int main() {
+    #ifdef RPC_PROFILE
+        _rpc_profile_init();
+    #endif
         while (1) {
             _handle_events();
         }
@@ -533,48 +928,587 @@ def _build_main(program_text, functions):
     
     return "\n".join(sections)
 
-def _pyprintf(stream):
-    format_string = stream.read_string()
-    in_special = False
-    args = []
-    for i in range(len(format_string)):
-        if in_special:
-            if format_string[i:i+1] == b'd':
-                args.append(stream.read_int32())
-            elif format_string[i:i+1] == b'f':
-                args.append(stream.read_float())
-            in_special = False
-        elif format_string[i:i+1] == b'%':
-            in_special = True
-
-    print(format_string.decode() % tuple(args), end='')
+# Must match the command numbers in pyprintf.c
+_PRINTF_INLINE = 1
+_PRINTF_DEFINE = 2
+_PRINTF_INTERNED = 3
+
+_printf_header = _Struct('<HH')
+_printf_length = _Struct('<H')
+
+# Struct code of the argument sent for each conversion
+_printf_codes = {
+    b'd': 'i', b'i': 'i', b'c': 'i',
+    b'u': 'I', b'o': 'I', b'x': 'I', b'X': 'I', b'p': 'I',
+    b'f': 'f', b'F': 'f', b'e': 'f', b'E': 'f', b'g': 'f', b'G': 'f',
+    b's': None, b'%': '',
+}
+
+_printf_spec = re.compile(
+    rb'%([-+ #0]*)(\*|\d+)?(?:\.(\*|\d*))?(hh|h|ll|l|L|z|j|t)?'
+    rb'([diucoxXpfFeEgGs%])')
+
+class _PrintfFormat:
+    """ Precompiled decoder for the packed arguments of a format
+
+    Runs of numeric arguments are decoded with a single struct while
+    strings are sent as a 16-bit length followed by the characters.
+
+    """
+    def __init__(self, format_string):
+        text = []
+        parts = []
+        codes = ''
+        position = 0
+        for match in _printf_spec.finditer(format_string):
+            text.append(format_string[position:match.start()]
+                        .replace(b'%', b'%%'))
+            position = match.end()
+            flags, width, precision, length, conversion = match.groups()
+            code = _printf_codes[conversion]
+            if conversion == b'%':
+                text.append(b'%%')
+                continue
+            if width == b'*':
+                codes += 'i'
+            if precision == b'*':
+                codes += 'i'
+            if code is None:
+                parts.append(_Struct('<' + codes))
+                parts.append(None)
+                codes = ''
+            elif length == b'll' and code in 'iI':
+                codes += 'q' if code == 'i' else 'Q'
+            else:
+                codes += code
+            if conversion == b'p':
+                flags += b'#'
+                conversion = b'x'
+            elif conversion == b'u':
+                conversion = b'd'
+            spec = b'%' + flags + (width or b'')
+            if precision is not None:
+                spec += b'.' + precision
+            text.append(spec + conversion)
+        text.append(format_string[position:].replace(b'%', b'%%'))
+        parts.append(_Struct('<' + codes))
+        self.text = b''.join(text).decode(errors='replace')
+        self._parts = [p for p in parts if p is None or p.size]
+        self._min_size = sum(2 if p is None else p.size for p in self._parts)
+
+    def format(self, data):
+        if len(data) < self._min_size:
+            data = bytes(data) + bytes(self._min_size - len(data))
+        args = []
+        offset = 0
+        for part in self._parts:
+            if part is None:
+                length = _printf_length.unpack_from(data, offset)[0]
+                offset += 2
+                args.append(bytes(data[offset:offset + length])
+                            .decode(errors='replace'))
+                offset += length
+            else:
+                args.extend(part.unpack_from(data, offset))
+                offset += part.size
+        return self.text % tuple(args)
+
+_printf_formats = {}
+
+def _printf_format(format_string):
+    if format_string not in _printf_formats:
+        _printf_formats[format_string] = _PrintfFormat(format_string)
+    return _printf_formats[format_string]
+
+# Formats interned by each program, keyed by its RPC stream
+_interned_formats = weakref.WeakKeyDictionary()
+
+def _pyprintf(command, stream):
+    if command == _PRINTF_INLINE:
+        format_string = stream.read(_printf_length.unpack(stream.read(2))[0])
+        printf_format = _printf_format(format_string)
+        data = stream.read(_printf_length.unpack(stream.read(2))[0])
+        print(printf_format.format(data), end='')
+        return
+    index, length = _printf_header.unpack(stream.read(4))
+    if command == _PRINTF_DEFINE:
+        formats = _interned_formats.setdefault(stream, {})
+        formats[index] = _printf_format(stream.read(length))
+    else:
+        data = stream.read(length)
+        print(_interned_formats[stream][index].format(data), end='')
 
 def _handle_command(command, stream):
-    if command == 1: # print command
-       _pyprintf(stream)
+    if command in (_PRINTF_INLINE, _PRINTF_DEFINE, _PRINTF_INTERNED):
+       _pyprintf(command, stream)
     else:
        raise RuntimeError(f'Unknown command {command}')
 
-def _function_wrapper(stream, index, adapter, return_type, *args):
+# Each request is framed by the command index and payload length
+_request_header = _Struct('ii')
+
+def _pack_request(rpc, index, adapter, args, notify=False):
+    """ Builds a request from the header and fixed size arguments
+    followed by the data of any array arguments. If `notify` is set
+    the microblaze raises the interrupt with the response.
+
+    """
+    payload = adapter.pack_args(*args)
+    # The fixed size part is read in one go once it is all in the
+    # channel so it must fit in both the channel and the buffer
+    limit = min(_RPC_BUFFER_SIZE,
+                rpc._rpc_stream.write_channel.length - 1)
+    if len(payload) > limit:
+        raise RuntimeError(f"Arguments need {len(payload)} bytes but at "
+                           f"most {limit} can be sent")
+    data = adapter.pack_data(*args)
+    # Array arguments are copied into the arena on the microblaze so
+    # together they are limited to the arena_size passed to the RPC,
+    # rounding each up to a whole word. The element count of each array
+    # is sent as a signed 16-bit value so an array is also limited to
+    # 32767 elements.
+    arena = sum((len(d) + 3) & ~3 for d in data)
+    if arena > rpc._arena_size:
+        raise RuntimeError(f"Array arguments need {arena} bytes but only "
+                           f"{rpc._arena_size} are available")
+    length = len(payload) | (_NOTIFY_FLAG if notify else 0)
+    return b''.join([_request_header.pack(index, length), payload] +
+                    data)
+
+def _drain_commands(rpc):
+    """ Handles the commands and fence acknowledgements already in the
+    response channel. The microblaze blocks once the channel is full so
+    this has to be done while waiting for space to send a request.
+
+    """
+    stream = rpc._rpc_stream
+    while stream.bytes_available():
+        command = stream.read(1)[0]
+        if command != 0:
+            _handle_command(command, stream)
+        elif rpc._posted_fences:
+            # Only fences can complete before the request being sent
+            rpc._voids_done = max(rpc._voids_done,
+                                  rpc._posted_fences.popleft())
+        else:
+            raise RuntimeError("Unexpected response from the microblaze")
+
+def _write_request(rpc, request):
+    """ Writes a whole request, waiting for space in the channel if
+    the microblaze hasn't caught up yet
+
+    """
+    stream = rpc._rpc_stream
+    while request:
+        written = stream.write(request)
+        request = request[written:]
+        if request and not written:
+            _drain_commands(rpc)
+
+def _wait_for_data(rpc):
+    """ Waits for the microblaze to start responding, spinning for
+    `spin_time` and then sleeping for increasing intervals up to
+    `sleep_time` to avoid burning CPU on long calls
+
+    """
+    stream = rpc._rpc_stream
+    if stream.bytes_available():
+        return
+    deadline = time.perf_counter() + rpc.spin_time
+    while time.perf_counter() < deadline:
+        if stream.bytes_available():
+            return
+    delay = _MIN_SLEEP
+    while not stream.bytes_available():
+        time.sleep(delay)
+        delay = min(delay * 2, rpc.sleep_time)
+
+def _wait_for_return(rpc):
+    """ Waits for the return command, handling any other commands
+    the microblaze sends before it
+
+    """
+    stream = rpc._rpc_stream
+    _wait_for_data(rpc)
+    command = stream.read(1)[0]
+    while command != 0:
+        _handle_command(command, stream)
+        command = stream.read(1)[0]
+
+def _drain_fences(rpc):
+    """ Reads the acknowledgements of posted fences which arrive
+    before the response to any later request
+
+    """
+    while rpc._posted_fences:
+        _wait_for_return(rpc)
+        rpc._voids_done = max(rpc._voids_done, rpc._posted_fences.popleft())
+
+async def _wait_for_return_async(rpc):
+    """ Equivalent of `_wait_for_return` which awaits the interrupt
+    instead of blocking
+
+    """
+    stream = rpc._rpc_stream
+    command = (await stream.read_exact_async(1))[0]
+    while command != 0:
+        _handle_command(command, stream)
+        command = (await stream.read_exact_async(1))[0]
+
+async def _drain_fences_async(rpc):
+    """ Equivalent of `_drain_fences` which awaits the interrupt
+    instead of blocking
+
+    """
+    while rpc._posted_fences:
+        await _wait_for_return_async(rpc)
+        rpc._voids_done = max(rpc._voids_done, rpc._posted_fences.popleft())
+
+def _check_sync(rpc):
+    """ Raises if an asynchronous call is using the channel as the
+    requests and responses of a synchronous call would be interleaved
+    with it
+
+    """
+    if rpc._async_lock.locked():
+        raise RuntimeError("Cannot use the RPC channel synchronously while "
+                           "an asynchronous call is in progress")
+
+_timestamps = _Struct('<4I')
+
+def _read_timestamps(rpc, adapter, sent):
+    """ Reads the cycle counts appended to a response when profiling
+    and adds the call to the timeline
+
+    """
+    cycles = _timestamps.unpack(rpc._rpc_stream.read(_timestamps.size))
+    rpc.timeline.add(adapter.name, sent, time.perf_counter(), cycles)
+
+def _read_response(rpc, adapter, return_type, args, sent=None):
+    """ Reads the response to a call, handling any commands
+    the microblaze sends before it
+
+    """
+    _wait_for_return(rpc)
+    response = adapter.receive_response(rpc._rpc_stream, *args)
+    if rpc.timeline is not None:
+        _read_timestamps(rpc, adapter, sent)
+    if return_type:
+        return return_type(response)
+    else:
+        return response
+
+def _function_wrapper(rpc, index, adapter, return_type, *args):
     """ Calls a function in the microblaze, designed to be used
     with functools.partial to build a new thing
 
     """
-    arg_string = struct.pack('l', index)
-    arg_string += adapter.pack_args(*args)
-    stream.write(arg_string)
+    _check_sync(rpc)
+    if rpc._batch is not None:
+        return rpc._batch.call(index, adapter, return_type, args)
+    if rpc.stats is not None:
+        return _timed_call(rpc, index, adapter, return_type, args)
+    request = _pack_request(rpc, index, adapter, args)
+    sent = time.perf_counter()
+    _write_request(rpc, request)
     if not adapter.returns:
+        rpc._voids_sent += 1
         return None
-    command = stream.read(1)[0]
-    while command != 0:
-        _handle_command(command, stream)
+    mark = rpc._voids_sent
+    _drain_fences(rpc)
+    response = _read_response(rpc, adapter, return_type, args, sent)
+    # Calls complete in order so every earlier void call is finished
+    rpc._voids_done = mark
+    return response
+
+def _timed_call(rpc, index, adapter, return_type, args):
+    """ Equivalent of `_function_wrapper` which records the time spent
+    in each phase of the call in `rpc.stats`
+
+    """
+    stream = rpc._rpc_stream
+    write_channel = stream.write_channel
+    read_channel = stream.read_channel
+    sent = write_channel.bytes_written
+    received = read_channel.bytes_read
+    stalls = write_channel.stalls
+    commands = 0
+    response = None
+    start = time.perf_counter()
+    request = _pack_request(rpc, index, adapter, args)
+    packed = time.perf_counter()
+    _write_request(rpc, request)
+    end = time.perf_counter()
+    phases = {'pack': packed - start, 'transmit': end - packed}
+    if adapter.returns:
+        transmitted = end
+        mark = rpc._voids_sent
+        _drain_fences(rpc)
+        _wait_for_data(rpc)
+        waited = time.perf_counter()
         command = stream.read(1)[0]
-    response = adapter.receive_response(stream, *args)
+        while command != 0:
+            _handle_command(command, stream)
+            commands += 1
+            command = stream.read(1)[0]
+        handled = time.perf_counter()
+        response = adapter.receive_response(stream, *args)
+        if return_type:
+            response = return_type(response)
+        if rpc.timeline is not None:
+            _read_timestamps(rpc, adapter, packed)
+        end = time.perf_counter()
+        rpc._voids_done = mark
+        phases['wait'] = waited - transmitted
+        phases['commands'] = handled - waited
+        phases['decode'] = end - handled
+    else:
+        rpc._voids_sent += 1
+    phases['total'] = end - start
+    rpc.stats.record(adapter.name, phases,
+                     write_channel.bytes_written - sent,
+                     read_channel.bytes_read - received,
+                     write_channel.stalls - stalls, commands)
+    return response
+
+async def _async_function_wrapper(rpc, index, adapter, return_type, *args):
+    """ Calls a function in the microblaze, awaiting the interrupt
+    raised with the response instead of spinning on the channel
+
+    """
+    if rpc._batch is not None:
+        raise RuntimeError("Cannot make asynchronous calls inside a batch")
+    stream = rpc._rpc_stream
+    start = time.perf_counter()
+    request = _pack_request(rpc, index, adapter, args,
+                            notify=adapter.returns)
+    async with rpc._async_lock:
+        stats = rpc.stats
+        if stats is not None:
+            sent = stream.write_channel.bytes_written
+            received = stream.read_channel.bytes_read
+        request_time = time.perf_counter()
+        while request:
+            written = stream.write(request)
+            request = request[written:]
+            if request:
+                if not written:
+                    _drain_commands(rpc)
+                await asyncio.sleep(0)
+        if not adapter.returns:
+            rpc._voids_sent += 1
+            if stats is not None:
+                _record_async(rpc, adapter, start, sent, received)
+            return None
+        mark = rpc._voids_sent
+        await _drain_fences_async(rpc)
+        # Short calls are done before the interrupt could be serviced
+        deadline = time.perf_counter() + rpc.spin_time
+        while not stream.bytes_available() and \
+                time.perf_counter() < deadline:
+            pass
+        # Only the start of the response needs waiting for, the rest
+        # is written straight after
+        await _wait_for_return_async(rpc)
+        response = adapter.receive_response(stream, *args)
+        if rpc.timeline is not None:
+            _read_timestamps(rpc, adapter, request_time)
+        rpc._voids_done = mark
+        if stats is not None:
+            _record_async(rpc, adapter, start, sent, received)
     if return_type:
         return return_type(response)
     else:
         return response
 
+def _record_async(rpc, adapter, start, sent, received):
+    stream = rpc._rpc_stream
+    rpc.stats.record(adapter.name,
+                     {'total': time.perf_counter() - start},
+                     stream.write_channel.bytes_written - sent,
+                     stream.read_channel.bytes_read - received)
+
+class RPCFuture:
+    """ Result of a function called inside of a batch
+
+    """
+    def __init__(self, batch):
+        self._batch = batch
+        self._done = False
+        self._value = None
+
+    def done(self):
+        """ Returns True once the call has completed
+
+        """
+        return self._done
+
+    def result(self):
+        """ Returns the value of the call, flushing the batch if the
+        call hasn't been sent yet
+
+        """
+        if not self._done:
+            self._batch.flush()
+        return self._value
+
+    def _set_result(self, value):
+        self._value = value
+        self._done = True
+
+class _BatchedCall:
+    def __init__(self, request, adapter, return_type, args, future):
+        self.request = request
+        self.adapter = adapter
+        self.return_type = return_type
+        self.args = args
+        self.future = future
+        self.void_mark = 0
+        self.sent = None
+
+class RPCBatch:
+    """ Queues calls to an RPC instance and sends them back-to-back
+
+    While the batch is active every function of the RPC instance
+    returns an `RPCFuture` rather than a value. The queued calls are
+    sent when the requests would no longer fit in `flush_threshold`
+    bytes, when `flush` is called or when the batch is exited. The
+    microblaze executes the calls in order.
+
+    Attributes
+    ----------
+    flush_threshold : int
+        Number of request bytes to queue before sending them. Defaults
+        to the free space of the empty RPC channel.
+    futures         : [RPCFuture]
+        Futures of all of the calls made in the batch
+
+    """
+    def __init__(self, rpc, flush_threshold=None):
+        self._rpc = rpc
+        self._pending = []
+        self._pending_bytes = 0
+        if flush_threshold is None:
+            flush_threshold = rpc._rpc_stream.write_channel.length - 1
+        self.flush_threshold = flush_threshold
+        self.futures = []
+
+    def __enter__(self):
+        if self._rpc._batch is not None:
+            raise RuntimeError("A batch is already active for this RPC")
+        self._rpc._batch = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._rpc._batch = None
+        if exc_type is None:
+            self.flush()
+
+    def call(self, index, adapter, return_type, args):
+        """ Queues a call and returns a future for its result
+
+        """
+        request = _pack_request(self._rpc, index, adapter, args)
+        if self._pending_bytes + len(request) > self.flush_threshold:
+            self.flush()
+        future = RPCFuture(self)
+        self._pending.append(
+            _BatchedCall(request, adapter, return_type, args, future))
+        self._pending_bytes += len(request)
+        self.futures.append(future)
+        return future
+
+    def flush(self):
+        """ Sends all queued calls and waits for their results
+
+        """
+        rpc = self._rpc
+        _check_sync(rpc)
+        stream = rpc._rpc_stream
+        pending = self._pending
+        self._pending = []
+        self._pending_bytes = 0
+        awaiting = []
+        for call in pending:
+            request = call.request
+            call.sent = time.perf_counter()
+            while request:
+                written = stream.write(request)
+                request = request[written:]
+                if request and awaiting:
+                    # Drain a response so the microblaze can make progress
+                    self._complete(rpc, awaiting.pop(0))
+                elif request and not written:
+                    _drain_commands(rpc)
+            if call.adapter.returns:
+                call.void_mark = rpc._voids_sent
+                awaiting.append(call)
+            else:
+                rpc._voids_sent += 1
+                call.future._set_result(None)
+        for call in awaiting:
+            self._complete(rpc, call)
+
+    def results(self):
+        """ Flushes the batch and returns the results of all calls
+
+        """
+        self.flush()
+        return [f.result() for f in self.futures]
+
+    @staticmethod
+    def _complete(rpc, call):
+        _drain_fences(rpc)
+        call.future._set_result(_read_response(
+            rpc, call.adapter, call.return_type, call.args, call.sent))
+        rpc._voids_done = max(rpc._voids_done, call.void_mark)
+
+def _load_parsed(key):
+    entry = parse_cache.lookup(key)
+    if entry is None:
+        return None
+    try:
+        with open(path.join(entry, 'parsed.pickle'), 'rb') as f:
+            functions, typedefs, enums, defined, main_text = pickle.load(f)
+    except Exception:
+        return None
+    visitor = FuncDefVisitor()
+    visitor.functions = functions
+    visitor.typedefs = typedefs
+    visitor.enums = enums
+    visitor.defined = defined
+    return visitor, main_text
+
+def _store_parsed(key, visitor, main_text):
+    with tempfile.TemporaryDirectory() as tempdir:
+        try:
+            with open(path.join(tempdir, 'parsed.pickle'), 'wb') as f:
+                pickle.dump((visitor.functions, visitor.typedefs,
+                             visitor.enums, visitor.defined, main_text), f)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return
+        parse_cache.store(key, tempdir, ['parsed.pickle'])
+
+def _parse_program(program_text, preprocessed, arena_size, overlay_slots=0,
+                   profile=None):
+    """ Returns the visitor and generated main for a program, reusing
+    the results from the parse cache if the preprocessed text and
+    this generator are unchanged
+
+    """
+    key = hash_key(preprocessed.text, program_text, arena_size, overlay_slots,
+                   profile, hash_file(__file__), pycparser.__version__)
+    cached = _load_parsed(key)
+    if cached:
+        return cached
+    ast = _parser.parse(preprocessed.text, filename='<stdin>')
+    visitor = FuncDefVisitor()
+    visitor.visit(ast)
+    main_text = _build_main(program_text, visitor.functions, arena_size,
+                            overlay_slots, profile)
+    _store_parsed(key, visitor, main_text)
+    return visitor, main_text
+
 def _create_typedef_classes(typedefs):
     """ Creates an anonymous class for each typedef in the C function
 
@@ -605,6 +1539,87 @@ def _create_typedef_classes(typedefs):
         classes[k] = Wrapper
     return classes
 
+def _rpc_program(iop, program_text, arena_size, overlay_slots=0,
+                 profile=None, report=None):
+    """ Returns the parsed interface, the text of the generated server
+    and the preprocessed form of both for an RPC program, timing each
+    stage in `report`
+
+    """
+    if report is None:
+        report = BuildReport()
+    with report.stage('preprocess'):
+        preprocessed = preprocess_full(program_text, mb_info=iop)
+    with report.stage('parse'):
+        visitor, main_text = _parse_program(program_text, preprocessed,
+                                            arena_size, overlay_slots,
+                                            profile)
+    with report.stage('preprocess'):
+        preprocessed = preprocessed.merge(
+            preprocess_full(_main_includes, mb_info=iop))
+    return visitor, main_text, preprocessed
+
+def _build_overlay(program_text, functions):
+    """ Returns the source of an overlay which wraps `functions` and
+    starts with the table of its call functions
+
+    """
+    sections = [program_text, _overlay_prelude]
+    for call_function in _build_call_functions(functions):
+        sections.append(_generator.visit(call_function))
+    entries = ', '.join(f'_rpc_call_{i}' for i in range(len(functions)))
+    sections.append('void (* const _rpc_overlay[])(void) '
+                    '__attribute__((section(".overlay_header"))) = '
+                    f'{{ {entries} }};')
+    return "\n".join(sections)
+
+def _build_rpc_job(job):
+    iop, program_text, arena_size, layout, profile = job
+    visitor, main_text, preprocessed = _rpc_program(iop, program_text,
+                                                    arena_size,
+                                                    profile=profile)
+    return build_program(iop, main_text, preprocessed=preprocessed,
+                         layout=layout)
+
+def compile_rpcs(programs, max_workers=None, arena_size=DEFAULT_ARENA_SIZE,
+                 layout=DEFAULT_LAYOUT, **kwargs):
+    """ Compiles the servers of several RPC programs concurrently and
+    then downloads them
+
+    Parameters
+    ----------
+    programs    : [(MicroblazeHierarchy or mb_info, str)]
+        Microblaze and program text of each RPC instance. Use
+        `MbioRPC.program_source` or `IopRPC.program_source` to get the
+        program text of those classes
+    max_workers : int
+        Number of compiler processes, defaults to the number of CPUs
+    arena_size  : int
+        Passed on to `MicroblazeRPC`
+    layout      : MailboxLayout
+        Passed on to `MicroblazeRPC`
+    kwargs      :
+        Passed on to `MicroblazeRPC`
+
+    Returns
+    -------
+    [MicroblazeRPC]
+        The RPC instances in the same order
+
+    """
+    programs = [(getattr(iop, 'mb_info', iop), text)
+                for iop, text in programs]
+    profile = None
+    if kwargs.get('profile'):
+        profile = tuple(kwargs.get('profile_timer', DEFAULT_PROFILE_TIMER))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(_build_rpc_job,
+                          [(iop, text, arena_size, layout, profile)
+                           for iop, text in programs]))
+    return [MicroblazeRPC(iop, text, arena_size=arena_size, layout=layout,
+                          **kwargs)
+            for iop, text in programs]
+
 class MicroblazeRPC:
     """ Provides a python interface to the Microblaze based on an RPC
     mechanism.
@@ -614,27 +1629,78 @@ class MicroblazeRPC:
 
     Functions are added as methods, the values in enumerations are
     added as constants to the class and types are added as classes.
+    Each function `f` also has a coroutine variant `f_async` which
+    awaits the microblaze's interrupt rather than polling for the
+    response.
 
     """
-    def __init__(self, iop, program_text):
+    # Dispatch table entries and bytes of memory below the mailbox kept
+    # free for functions added to the running server, see `ResidentRPC`
+    _overlay_slots = 0
+    _reserve = 0
+
+    def __init__(self, iop, program_text, arena_size=DEFAULT_ARENA_SIZE,
+                 layout=DEFAULT_LAYOUT, spin_time=DEFAULT_SPIN_TIME,
+                 sleep_time=DEFAULT_SLEEP_TIME, profile=False,
+                 profile_timer=DEFAULT_PROFILE_TIMER,
+                 timer_frequency=DEFAULT_TIMER_FREQUENCY):
         """ Create a new RPC instance
 
         Parameters
         ----------
-        iop          : MicroblazeHierarchy or mb_info
+        iop             : MicroblazeHierarchy or mb_info
             Microblaze instance to run the RPC server on
-        program_text : str
+        program_text    : str
             Source of the program to extract functions from
+        arena_size      : int
+            Bytes reserved on the microblaze for the array arguments
+            of a single call. Nothing is reserved if no function takes
+            an array argument
+        layout          : MailboxLayout
+            Placement and sizes of the mailbox channels. Larger RPC
+            channels reduce the number of round trips for big transfers
+        spin_time       : float
+            Seconds to spin waiting for a response before sleeping, or
+            awaiting the interrupt for asynchronous calls. Can be changed
+            later through the `spin_time` attribute
+        sleep_time      : float
+            Longest interval in seconds to sleep between checks for a
+            response once spinning has finished. Can be changed later
+            through the `sleep_time` attribute
+        profile         : bool
+            Timestamp each call on the microblaze and record them
+            with the host's times in the `timeline` attribute
+        profile_timer   : (int, int)
+            Timer and channel to count cycles with when profiling.
+            The channel can't be used by the program at the same time
+        timer_frequency : float
+            Frequency in Hz the timer counts at
 
         """
-        preprocessed = preprocess(program_text, mb_info=iop);
-        ast = _parser.parse(preprocessed, filename='<stdin>')
-        visitor = FuncDefVisitor()
-        visitor.visit(ast)
-        main_text = _build_main(program_text, visitor.functions)
+        profile_timer = tuple(profile_timer) if profile else None
+        report = BuildReport()
+        visitor, main_text, preprocessed = _rpc_program(
+            iop, program_text, arena_size, self._overlay_slots,
+            profile_timer, report)
         typedef_classes = _create_typedef_classes(visitor.typedefs)
-        self._mb = MicroblazeProgram(iop, main_text)
-        self._rpc_stream = SimpleMBStream(self._mb, read_offset=0xFC00, write_offset=0xF800)
+        self._arena_size = _arena_needed(visitor.functions, arena_size,
+                                         self._overlay_slots)
+        self.spin_time = spin_time
+        self.sleep_time = sleep_time
+        self._batch = None
+        self.stats = None
+        self.timeline = None
+        if profile:
+            self.timeline = CallTimeline(timer_frequency)
+        self._voids_sent = 0
+        self._voids_done = 0
+        self._posted_fences = collections.deque()
+        self._mb = MicroblazeProgram(iop, main_text,
+                                     preprocessed=preprocessed, layout=layout,
+                                     reserve=self._reserve, report=report)
+        self._rpc_stream = InterruptMBStream(
+            self._mb, **layout.stream_args('rpc_out', 'rpc_in'))
+        self._async_lock = asyncio.Lock()
         self._build_functions(visitor.functions, typedef_classes)
         self._build_constants(visitor.enums)
         self._populate_typedefs(typedef_classes, visitor.functions)
@@ -646,16 +1712,21 @@ class MicroblazeRPC:
                 setattr(self, name, value)
                 
     def _build_functions(self, functions, typedef_classes):
-        index = 0
-        for k, v in functions.items():
-            return_type = None
-            if v.return_interface.typedefname:
-                return_type = typedef_classes[v.return_interface.typedefname]
-            setattr(self, k, 
-                    functools.partial(
-                        _function_wrapper, self._rpc_stream, index, v, return_type)
-                    )
-            index += 1
+        for index, (k, v) in enumerate(functions.items()):
+            self._build_function(index, k, v, typedef_classes)
+
+    def _build_function(self, index, k, v, typedef_classes):
+        return_type = None
+        if v.return_interface.typedefname:
+            return_type = typedef_classes[v.return_interface.typedefname]
+        setattr(self, k, 
+                functools.partial(
+                    _function_wrapper, self, index, v, return_type)
+                )
+        setattr(self, f'{k}_async',
+                functools.partial(
+                    _async_function_wrapper, self, index, v, return_type)
+                )
     
     def _populate_typedefs(self, typedef_classes, functions):
         for name, cls in typedef_classes.items():
@@ -665,8 +1736,112 @@ class MicroblazeRPC:
                     if len(func.arg_interfaces) > 0 and func.arg_interfaces[0].typedefname == name:
                         setattr(cls, subname,
                                 functools.partialmethod(cls._call_func, getattr(self, fname)))
+                        setattr(cls, f'{subname}_async',
+                                functools.partialmethod(cls._call_func, getattr(self, f'{fname}_async')))
                     else:
                         setattr(cls, subname, getattr(self, fname))
+                        setattr(cls, f'{subname}_async', getattr(self, f'{fname}_async'))
+
+    @property
+    def report(self):
+        """`BuildReport` of the server running on the microblaze
+
+        """
+        return self._mb.report
+
+    @property
+    def outstanding(self):
+        """Number of void calls sent that may not have completed yet
+
+        """
+        return self._voids_sent - self._voids_done
+
+    def fence(self):
+        """Waits until the microblaze has completed every call sent
+        so far
+
+        Calls to functions without a return value don't wait for the
+        microblaze so this should be used before depending on their
+        side-effects. Any active batch is flushed first.
+
+        """
+        _check_sync(self)
+        if self._batch is not None:
+            self._batch.flush()
+        mark = self._voids_sent
+        _write_request(self,
+                       _request_header.pack(_FENCE_COMMAND, 0))
+        _drain_fences(self)
+        _wait_for_return(self)
+        self._voids_done = mark
+
+    def post_fence(self):
+        """Sends a fence without waiting for it to complete
+
+        Returns
+        -------
+        int
+            Mark to pass to `wait` to wait for every call sent before
+            the fence
+
+        """
+        _check_sync(self)
+        if self._batch is not None:
+            self._batch.flush()
+        mark = self._voids_sent
+        _write_request(self,
+                       _request_header.pack(_FENCE_COMMAND, 0))
+        self._posted_fences.append(mark)
+        return mark
+
+    def wait(self, mark):
+        """Waits until the calls before the fence that returned `mark`
+        have completed
+
+        """
+        _check_sync(self)
+        while self._voids_done < mark and self._posted_fences:
+            _wait_for_return(self)
+            self._voids_done = max(self._voids_done,
+                                   self._posted_fences.popleft())
+
+    def enable_stats(self):
+        """Starts recording the latency of each phase of the calls and
+        the data moved through the mailbox, see `RPCStats`
+
+        Returns
+        -------
+        RPCStats
+            The statistics, also available as the `stats` attribute
+
+        """
+        if self.stats is None:
+            self.stats = RPCStats({
+                'rpc_in': self._rpc_stream.write_channel,
+                'rpc_out': self._rpc_stream.read_channel,
+                'stdin': self._mb.stream.write_channel,
+                'stdout': self._mb.stream.read_channel})
+        return self.stats
+
+    def disable_stats(self):
+        """Stops recording statistics
+
+        """
+        self.stats = None
+
+    def batch(self, flush_threshold=None):
+        """Returns a context manager that queues calls and sends them
+        to the microblaze back-to-back
+
+        Parameters
+        ----------
+        flush_threshold : int
+            Number of request bytes to queue before sending. Defaults
+            to the free space of the empty RPC channel
+
+        """
+        return RPCBatch(self, flush_threshold)
+
     def reset(self):
         """Reset and free the microblaze for use by other programs
 
@@ -678,7 +1853,7 @@ class MbioRPC(MicroblazeRPC):
     """Provides access to the basic `mbio` interface through python
 
     """
-    def __init__(self, iop, modules=[]):
+    def __init__(self, iop, modules=[], **kwargs):
         """Create an instance of the RPC
 
         Parameters
@@ -687,12 +1862,21 @@ class MbioRPC(MicroblazeRPC):
             Microblaze instance to run the RPC server on
         modules : [str]
             Names of the modules to add to the base API
+        kwargs  :
+            Passed on to `MicroblazeRPC`
+
+        """
+        super().__init__(iop, self.program_source(modules), **kwargs)
+
+    @staticmethod
+    def program_source(modules=[]):
+        """Returns the program text used for the given `modules`
 
         """
         header_text = ["#include <mbio.h>"]
         for module in modules:
             header_text.append(f'#include <{module}.h>')
-        super().__init__(iop, "\n".join(header_text))
+        return "\n".join(header_text)
 
 
 class IopRPC(MicroblazeRPC):
@@ -700,7 +1884,7 @@ class IopRPC(MicroblazeRPC):
     interfaces through python
 
     """
-    def __init__(self, iop, modules=[]):
+    def __init__(self, iop, modules=[], **kwargs):
         """Create an instance of the RPC
 
         Parameters
@@ -709,9 +1893,153 @@ class IopRPC(MicroblazeRPC):
             Microblaze instance to run the RPC server on
         modules : [str]
             Names of the modules to add to the base API
+        kwargs  :
+            Passed on to `MicroblazeRPC`
+
+        """
+        super().__init__(iop, self.program_source(modules), **kwargs)
+
+    @staticmethod
+    def program_source(modules=[]):
+        """Returns the program text used for the given `modules`
 
         """
         header_text = ["#include <mbio.h>", "#include <iop.h>"]
         for module in modules:
             header_text.append(f'#include <{module}.h>')
-        super().__init__(iop, "\n".join(header_text))
+        return "\n".join(header_text)
+
+
+# Default bytes of memory and number of function table entries kept free
+# for functions added to a `ResidentRPC`
+DEFAULT_OVERLAY_SIZE = 0x2000
+DEFAULT_OVERLAY_SLOTS = 64
+
+class ResidentRPC(MicroblazeRPC):
+    """Long-lived `mbio` RPC server which new functions can be added to
+    without replacing the running program
+
+    A region of memory below the mailbox is kept free when the server
+    is built. `add_functions` links new functions against the running
+    server, writes them into the region and registers them in the
+    dispatch table so the state of the Microblaze is preserved and
+    only the new functions need compiling.
+
+    """
+    def __init__(self, iop, modules=[], overlay_size=DEFAULT_OVERLAY_SIZE,
+                 overlay_slots=DEFAULT_OVERLAY_SLOTS, layout=DEFAULT_LAYOUT,
+                 **kwargs):
+        """Create the server
+
+        Parameters
+        ----------
+        iop           : MicroblazeHierary or mb_info dict
+            Microblaze instance to run the RPC server on
+        modules       : [str]
+            Names of the modules to add to the base API
+        overlay_size  : int
+            Bytes of memory to keep for added functions, a multiple of 4
+        overlay_slots : int
+            Number of functions that can be added
+        layout        : MailboxLayout
+            Passed on to `MicroblazeRPC`
+        kwargs        :
+            Passed on to `MicroblazeRPC`
+
+        """
+        self._overlay_slots = overlay_slots
+        self._reserve = overlay_size
+        super().__init__(iop, MbioRPC.program_source(modules), layout=layout,
+                         **kwargs)
+        self.overlay_base = layout.base - overlay_size
+        self.overlay_size = overlay_size
+        self.overlay_used = 0
+        self._overlay_functions = {}
+
+    def add_functions(self, program_text):
+        """Compiles the functions defined in `program_text` and adds them
+        to the running server
+
+        The functions can call anything linked into the server and are
+        added as methods in the same way as for `MicroblazeRPC`. Adding
+        a function with the same name as an earlier one replaces it but
+        the memory of the earlier version is only reclaimed by
+        `reset_overlays`.
+
+        Parameters
+        ----------
+        program_text : str
+            Source defining the functions to add
+
+        Returns
+        -------
+        dict
+            Interfaces of the added functions keyed by name
+
+        """
+        mb = self._mb
+        preprocessed = preprocess_full(program_text, mb_info=mb._mb_info)
+        ast = _parser.parse(preprocessed.text, filename='<stdin>')
+        visitor = FuncDefVisitor()
+        visitor.visit(ast)
+        functions = {name: f for name, f in visitor.functions.items()
+                     if name in visitor.defined and
+                     not f.filename.endswith('.h')}
+        for name in functions:
+            if name in self.visitor.functions:
+                raise RuntimeError(f"{name} is already part of the server")
+        added = [name for name in functions
+                 if name not in self._overlay_functions]
+        if len(self._overlay_functions) + len(added) > self._overlay_slots:
+            raise RuntimeError("No free slots in the function table, "
+                               "call reset_overlays to reclaim them")
+        if not functions:
+            return functions
+        entry = build_overlay(mb._mb_info,
+                              _build_overlay(program_text, functions),
+                              path.join(mb.entry, 'a.out'),
+                              self.overlay_base + self.overlay_used,
+                              self.overlay_size - self.overlay_used,
+                              bsp=mb._bsp, preprocessed=preprocessed)
+        with open(path.join(entry, 'a.bin'), 'rb') as f:
+            image = f.read()
+        # Writes need to be whole words
+        image += bytes(-len(image) % 4)
+        addresses = struct.unpack_from(f'<{len(functions)}I', image)
+
+        # Earlier calls may still be running code from the region
+        self.fence()
+        mb.mmio.write(self.overlay_base + self.overlay_used, image)
+        self.overlay_used += len(image)
+        typedef_classes = _create_typedef_classes(visitor.typedefs)
+        first_slot = len(self.visitor.functions)
+        for (name, adapter), address in zip(functions.items(), addresses):
+            if name not in self._overlay_functions:
+                self._overlay_functions[name] = (
+                    first_slot + len(self._overlay_functions))
+            slot = self._overlay_functions[name]
+            _write_request(self,
+                           _request_header.pack(_REGISTER_COMMAND,
+                                                _register_args.size) +
+                           _register_args.pack(slot, address))
+            self._build_function(slot, name, adapter, typedef_classes)
+        self._populate_typedefs(typedef_classes, functions)
+        self.fence()
+        return functions
+
+    def reset_overlays(self):
+        """Removes every added function and frees the memory they were
+        loaded into
+
+        """
+        self.fence()
+        for name, slot in self._overlay_functions.items():
+            _write_request(self,
+                           _request_header.pack(_REGISTER_COMMAND,
+                                                _register_args.size) +
+                           _register_args.pack(slot, 0))
+            delattr(self, name)
+            delattr(self, f'{name}_async')
+        self._overlay_functions = {}
+        self.overlay_used = 0
+        self.fence()
@@ -0,0 +1,242 @@
+#   Copyright (c) 2016, Xilinx, Inc.
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import asyncio
+import numpy as np
+
+from .compile import MicroblazeProgram
+from .streams import DEFAULT_LAYOUT
+
+__author__ = "Peter Ogden"
+__copyright__ = "Copyright 2017, Xilinx"
+__email__ = "ogden@xilinx.com"
+
+
+# Device type, open function, read function and default arguments of the
+# open function for each kind of mbio device that can be sampled
+_SAMPLE_DEVICES = {
+    'analog': ('analog', 'analog_open', 'analog_read_raw', (0,)),
+    'gpio': ('gpio', 'gpio_open_all', 'gpio_read', (0, 1)),
+}
+
+_sampler_template = """
+#include <mbio.h>
+#include <mailbox_io.h>
+#include <unistd.h>
+
+#define BLOCK_SIZE {block_size}
+
+static struct {{
+    unsigned int sequence;
+    unsigned int dropped;
+    int samples[BLOCK_SIZE];
+}} block;
+
+int main() {{
+    {type} device = {open}({args});
+    timer t = timer_open({timer});
+    while (1) {{
+        for (int i = 0; i < BLOCK_SIZE; ++i) {{
+            block.samples[i] = {read}(device);
+            timer_delay_us(t, 0, {period});
+        }}
+        if (mailbox_available(STDOUT_FILENO) >= sizeof(block)) {{
+            write(STDOUT_FILENO, &block, sizeof(block));
+            block.sequence++;
+        }} else {{
+            block.dropped += BLOCK_SIZE;
+        }}
+    }}
+}}
+"""
+
+_HEADER_SIZE = 8
+
+
+class SampleStream:
+    """Continuously samples an mbio device on a Microblaze
+
+    The Microblaze reads the device at a fixed rate and sends blocks of
+    samples through the stdout channel. A block is dropped on the
+    Microblaze if there is no space for it in the channel. Samples can
+    either be consumed block by block with `blocks` or collected in the
+    background into a ring buffer with `start` and then retrieved with
+    `read` and `latest`.
+
+    Attributes
+    ----------
+    dropped  : int
+        Samples dropped by the Microblaze because the channel was full
+    overruns : int
+        Samples overwritten in the ring buffer before they were read
+    received : int
+        Samples received from the Microblaze
+
+    """
+    def __init__(self, iop, device='analog', args=None, rate=1000,
+                 timer=0, block_size=64, buffer_size=65536,
+                 layout=DEFAULT_LAYOUT):
+        """Create the sampler and start it running on the Microblaze
+
+        Parameters
+        ----------
+        iop         : MicroblazeHierarchy or mb_info dict
+            Microblaze to run the sampler on
+        device      : str
+            Kind of mbio device to sample - 'analog' or 'gpio'
+        args        : tuple
+            Arguments passed to the device's open function, defaults to
+            (0,) for 'analog' and (0, 1) for 'gpio'
+        rate        : float
+            Sample rate in Hz. The time taken to read the device is not
+            accounted for so the achieved rate is slightly lower
+        timer       : int
+            Index of the timer used to pace the sampling
+        block_size  : int
+            Number of samples sent in each block
+        buffer_size : int
+            Number of samples held in the host ring buffer
+        layout      : MailboxLayout
+            Channel layout of the Microblaze program
+
+        """
+        if device not in _SAMPLE_DEVICES:
+            raise RuntimeError(f"Cannot sample device type {device}")
+        self._block_bytes = _HEADER_SIZE + 4 * block_size
+        if self._block_bytes >= layout.size('stdout') - 8:
+            raise RuntimeError(
+                f"Block of {block_size} samples does not fit in the "
+                "stdout channel")
+        type_, open_, read, default_args = _SAMPLE_DEVICES[device]
+        if args is None:
+            args = default_args
+        source = _sampler_template.format(
+            block_size=block_size, type=type_, open=open_, read=read,
+            args=', '.join(str(a) for a in args), timer=timer,
+            period=max(1, int(round(1e6 / rate))))
+        self.block_size = block_size
+        self.dropped = 0
+        self.overruns = 0
+        self.received = 0
+        self._buffer = np.zeros(buffer_size, dtype=np.int32)
+        self._head = 0
+        self._tail = 0
+        self._task = None
+        self._mb = MicroblazeProgram(iop, source, layout=layout)
+        self._stream = self._mb.stream
+
+    def _receive(self, data):
+        header = np.frombuffer(data, dtype='<u4', count=2)
+        samples = np.frombuffer(data, dtype='<i4', offset=_HEADER_SIZE)
+        self.dropped = int(header[1])
+        self.received += len(samples)
+        return samples
+
+    def blocks(self):
+        """Generator returning each block of samples as it arrives
+
+        """
+        if self._task:
+            raise RuntimeError("Samples are being collected by start()")
+        while True:
+            yield self._receive(self._stream.read(self._block_bytes))
+
+    def _append(self, samples):
+        size = len(self._buffer)
+        if len(samples) > size:
+            self._head += len(samples) - size
+            samples = samples[-size:]
+        count = len(samples)
+        start = self._head % size
+        end_block = min(count, size - start)
+        self._buffer[start:start + end_block] = samples[:end_block]
+        self._buffer[:count - end_block] = samples[end_block:]
+        self._head += count
+        if self._head - self._tail > size:
+            self.overruns += self._head - self._tail - size
+            self._tail = self._head - size
+
+    def _copy_out(self, start, end):
+        size = len(self._buffer)
+        index = np.arange(start, end) % size
+        return self._buffer[index]
+
+    async def _pump(self):
+        while True:
+            data = await self._stream.read_exact_async(self._block_bytes)
+            self._append(self._receive(data))
+
+    def start(self):
+        """Start collecting samples into the ring buffer in the
+        background. Requires a running asyncio event loop as provided
+        by Jupyter.
+
+        """
+        if not self._task:
+            self._task = asyncio.ensure_future(self._pump())
+
+    def stop(self):
+        """Stop collecting samples in the background
+
+        """
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def available(self):
+        """Number of unread samples in the ring buffer
+
+        """
+        return self._head - self._tail
+
+    def read(self, n=-1):
+        """Return up to `n` of the oldest unread samples from the ring
+        buffer, or all of them if `n` is negative
+
+        """
+        available = self.available()
+        if n < 0 or n > available:
+            n = available
+        data = self._copy_out(self._tail, self._tail + n)
+        self._tail += n
+        return data
+
+    def latest(self, n):
+        """Return the most recent `n` samples without consuming them
+
+        """
+        n = min(n, len(self._buffer), self._head)
+        return self._copy_out(self._head - n, self._head)
+
+    def reset(self):
+        """Stop sampling and free the Microblaze
+
+        """
+        self.stop()
+        self._mb.reset()
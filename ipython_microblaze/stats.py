@@ -0,0 +1,385 @@
+#   Copyright (c) 2016, Xilinx, Inc.
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import collections
+import json
+import time
+
+__author__ = "Peter Ogden"
+__copyright__ = "Copyright 2017, Xilinx"
+__email__ = "ogden@xilinx.com"
+
+
+class LatencyHistogram:
+    """Distribution of durations in power of two bins
+
+    Bin `i` counts the durations shorter than 2**i microseconds which
+    don't fit in an earlier bin with the last bin taking everything
+    longer.
+
+    Attributes
+    ----------
+    count : int
+        Number of durations recorded
+    total : float
+        Sum of the durations in seconds
+    min   : float
+        Shortest duration in seconds, None if nothing is recorded
+    max   : float
+        Longest duration in seconds
+    bins  : [int]
+        Number of durations in each bin
+
+    """
+    BINS = 32
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+        self.bins = [0] * self.BINS
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.bins[min(int(seconds * 1e6).bit_length(), self.BINS - 1)] += 1
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, q):
+        """Upper bound in seconds of the `q`th percentile duration
+
+        """
+        if not self.count:
+            return 0.0
+        target = q / 100 * self.count
+        seen = 0
+        for i, n in enumerate(self.bins):
+            seen += n
+            if seen >= target:
+                return min((1 << i) * 1e-6, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {'count': self.count, 'total': self.total,
+                'mean': self.mean, 'min': self.min, 'max': self.max,
+                'p50': self.percentile(50), 'p99': self.percentile(99),
+                'bins': list(self.bins)}
+
+
+class FunctionStats:
+    """Statistics of the calls to a single RPC function
+
+    Attributes
+    ----------
+    name           : str
+        Name of the function
+    calls          : int
+        Number of calls recorded
+    bytes_sent     : int
+        Request bytes written to the RPC channel
+    bytes_received : int
+        Response bytes read from the RPC channel including any
+        commands, such as printf output, interleaved with the response
+    stalls         : int
+        Writes of requests cut short by a full channel
+    commands       : int
+        Commands handled while waiting for the responses
+    phases         : {str: LatencyHistogram}
+        Time spent in each phase of the calls, see `RPCStats`
+
+    """
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.stalls = 0
+        self.commands = 0
+        self.phases = {phase: LatencyHistogram() for phase in RPCStats.PHASES}
+
+    def as_dict(self):
+        return {'calls': self.calls, 'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received,
+                'stalls': self.stalls, 'commands': self.commands,
+                'phases': {phase: histogram.as_dict()
+                           for phase, histogram in self.phases.items()
+                           if histogram.count}}
+
+
+class RPCStats:
+    """Statistics of the calls made through an RPC instance
+
+    Calls are split into phases:
+
+    pack     : encoding the arguments into the request
+    transmit : writing the request into the RPC channel
+    wait     : waiting for the start of the response
+    commands : handling commands such as printf sent before the response
+    decode   : reading the response and updating array arguments
+    total    : the whole call
+
+    Functions without a return value only have the first two phases
+    and asynchronous calls only record their total time. Calls made in
+    a batch are not recorded.
+
+    Attributes
+    ----------
+    functions : {str: FunctionStats}
+        Statistics of each function that has been called
+    started   : float
+        Time the statistics were last reset
+
+    """
+    PHASES = ('pack', 'transmit', 'wait', 'commands', 'decode', 'total')
+
+    def __init__(self, channels):
+        self._channels = channels
+        self.reset()
+
+    def reset(self):
+        """Clears the statistics
+
+        """
+        self.functions = {}
+        self.started = time.time()
+        self._baseline = {name: (c.bytes_written, c.bytes_read, c.stalls)
+                          for name, c in self._channels.items()}
+
+    def record(self, name, phases, sent=0, received=0, stalls=0,
+               commands=0):
+        """Adds a call to function `name` with the durations of the
+        `phases` it went through in seconds
+
+        """
+        function = self.functions.get(name)
+        if function is None:
+            function = self.functions[name] = FunctionStats(name)
+        function.calls += 1
+        function.bytes_sent += sent
+        function.bytes_received += received
+        function.stalls += stalls
+        function.commands += commands
+        for phase, seconds in phases.items():
+            function.phases[phase].add(seconds)
+
+    @property
+    def channels(self):
+        """Bytes moved through and write stalls of each mailbox channel
+        since the statistics were reset
+
+        """
+        result = {}
+        for name, channel in self._channels.items():
+            written, read, stalls = self._baseline[name]
+            result[name] = {'bytes_written': channel.bytes_written - written,
+                            'bytes_read': channel.bytes_read - read,
+                            'stalls': channel.stalls - stalls}
+        return result
+
+    def as_dict(self):
+        return {'started': self.started,
+                'elapsed': time.time() - self.started,
+                'channels': self.channels,
+                'functions': {name: function.as_dict()
+                              for name, function in self.functions.items()}}
+
+    def export(self, filename):
+        """Writes the statistics to `filename` as JSON
+
+        """
+        with open(filename, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+    def summary(self):
+        """Returns a table of the functions ordered by the total time
+        spent in them with durations in microseconds
+
+        """
+        lines = [f'{"function":<24}{"calls":>8}{"mean":>10}{"p99":>10}'
+                 f'{"wait":>10}{"sent":>10}{"recv":>10}{"stalls":>8}']
+        ordered = sorted(self.functions.values(),
+                         key=lambda f: f.phases['total'].total, reverse=True)
+        for f in ordered:
+            total = f.phases['total']
+            lines.append(f'{f.name:<24}{f.calls:>8}'
+                         f'{total.mean * 1e6:>10.1f}'
+                         f'{total.percentile(99) * 1e6:>10.1f}'
+                         f'{f.phases["wait"].mean * 1e6:>10.1f}'
+                         f'{f.bytes_sent:>10}{f.bytes_received:>10}'
+                         f'{f.stalls:>8}')
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return self.summary()
+
+
+TimelineEntry = collections.namedtuple(
+    'TimelineEntry',
+    ['name', 'sent', 'done', 'received', 'started', 'finished', 'responded'])
+TimelineEntry.__doc__ = """A call on the timeline
+
+`sent` and `done` are the host's `time.perf_counter` when the request
+was written and the response read. The other times are seconds on the
+Microblaze's timer for the arrival of the request, the start of the
+call, the start of the response and the end of the response.
+
+"""
+
+
+class CallTimeline:
+    """Merges the timestamps the Microblaze appends to responses with
+    the host's times for each call
+
+    The Microblaze's 32-bit cycle counts are unwrapped using the time
+    elapsed on the host between calls and the offset between the two
+    clocks is estimated from the bounds every call gives: a request
+    can't arrive before it was sent and a response can't finish after
+    it was read.
+
+    Attributes
+    ----------
+    frequency : float
+        Frequency of the Microblaze's timer in Hz
+    entries   : deque of TimelineEntry
+        The most recent calls, oldest first
+
+    """
+    _WRAP = 1 << 32
+
+    def __init__(self, frequency, max_entries=100000):
+        self.frequency = frequency
+        self.entries = collections.deque(maxlen=max_entries)
+        self.clear()
+
+    def clear(self):
+        """Removes every call from the timeline
+
+        """
+        self.entries.clear()
+        self._last = None
+        self._low = float('-inf')
+        self._high = float('inf')
+
+    def add(self, name, sent, done, cycles):
+        """Adds a call to function `name` sent and completed at the host
+        times `sent` and `done` with the Microblaze's raw `cycles`
+
+        """
+        receive, start, finish, respond = cycles
+        if self._last is None:
+            base = receive
+        else:
+            last_sent, last_receive, last_base = self._last
+            delta = (receive - last_receive) % self._WRAP
+            expected = (sent - last_sent) * self.frequency
+            wraps = max(round((expected - delta) / self._WRAP), 0)
+            base = last_base + delta + wraps * self._WRAP
+        self._last = (sent, receive, base)
+        received = base / self.frequency
+        started = received + (start - receive) % self._WRAP / self.frequency
+        finished = received + (finish - receive) % self._WRAP / self.frequency
+        responded = received + (respond - receive) % self._WRAP / self.frequency
+        self._low = max(self._low, sent - received)
+        self._high = min(self._high, done - responded)
+        self.entries.append(TimelineEntry(name, sent, done, received,
+                                          started, finished, responded))
+
+    @property
+    def offset(self):
+        """Estimated seconds to add to a Microblaze time to get the
+        host's time
+
+        """
+        if self._high == float('inf'):
+            return self._low
+        return (self._low + self._high) / 2
+
+    def calls(self):
+        """Returns every call with all of the times on the host's clock
+        and the durations of each stage
+
+        """
+        offset = self.offset
+        result = []
+        for e in self.entries:
+            result.append({
+                'name': e.name,
+                'sent': e.sent,
+                'received': e.received + offset,
+                'started': e.started + offset,
+                'finished': e.finished + offset,
+                'responded': e.responded + offset,
+                'done': e.done,
+                'latency': e.done - e.sent,
+                'receive': e.started - e.received,
+                'execute': e.finished - e.started,
+                'respond': e.responded - e.finished,
+                'host': (e.done - e.sent) - (e.responded - e.received),
+            })
+        return result
+
+    def summary(self):
+        """Returns a table of the mean duration of each stage of the
+        calls to each function in microseconds
+
+        """
+        stages = ['latency', 'receive', 'execute', 'respond', 'host']
+        totals = {}
+        for call in self.calls():
+            entry = totals.setdefault(call['name'], [0] + [0.0] * len(stages))
+            entry[0] += 1
+            for i, stage in enumerate(stages):
+                entry[i + 1] += call[stage]
+        lines = [f'{"function":<24}{"calls":>8}' +
+                 ''.join(f'{stage:>10}' for stage in stages)]
+        for name, entry in totals.items():
+            count = entry[0]
+            lines.append(f'{name:<24}{count:>8}' +
+                         ''.join(f'{t / count * 1e6:>10.1f}'
+                                 for t in entry[1:]))
+        return '\n'.join(lines)
+
+    def export(self, filename):
+        """Writes the calls to `filename` as JSON
+
+        """
+        with open(filename, 'w') as f:
+            json.dump({'frequency': self.frequency, 'offset': self.offset,
+                       'calls': self.calls()}, f, indent=2)
+
+    def __str__(self):
+        return self.summary()
@@ -27,8 +27,12 @@
 #   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
 #   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import collections
 import numpy as np
+import re
 import struct
+import threading
+import time
 
 __author__ = "Peter Ogden"
 __copyright__ = "Copyright 2017, Xilinx"
@@ -36,6 +40,18 @@ __email__ = "ogden@xilinx.com"
 
 
 class SimpleMBChannel:
+    """Ring buffer shared with the Microblaze
+
+    The first control word is the write pointer and the second the
+    read pointer. Each side only ever updates its own pointer so the
+    local pointer is cached and only the remote one is read from the
+    shared memory. Only one channel object should be used for each
+    side of a ring.
+
+    `bytes_written` and `bytes_read` count the data moved through the
+    channel and `stalls` the writes cut short by a full ring.
+
+    """
     def __init__(self, buffer, offset=0, length=0):
         self.control_array = np.frombuffer(buffer, count=2,
                                            offset=offset, dtype=np.uint32)
@@ -44,67 +60,399 @@ class SimpleMBChannel:
         self.data_array = np.frombuffer(buffer, count=(length - 8),
                                         offset=offset + 8, dtype=np.uint8)
         self.length = length - 8
+        # Plain memoryview slices have much lower per-call overhead than
+        # NumPy for the small transfers typical of the channels
+        self._control = memoryview(buffer)[offset:offset + 8].cast('I')
+        self._data = memoryview(buffer)[offset + 8:offset + length]
+        self._write_pointer = self._control[0]
+        self._read_pointer = self._control[1]
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.stalls = 0
 
     def write(self, b):
-        written = int(self.control_array[0])
+        write_array = memoryview(b).cast('B')
+        written = self._write_pointer
         read = self._safe_control_read(1)
-        available = (read - written - 1 + 2 * self.length) % self.length
-        to_write = min(len(b), available)
-        write_array = np.fromstring(b, np.uint8)
+        available = (read - written - 1) % self.length
+        to_write = min(len(write_array), available)
         end_block = min(to_write, self.length - written)
-        self.data_array[written:written + end_block] = write_array[0:end_block]
+        self._data[written:written + end_block] = write_array[0:end_block]
         # Automatically wrap the write if necessary
         if end_block < to_write:
-            self.data_array[0:to_write-end_block] = \
-                write_array[end_block:to_write]
+            self._data[0:to_write-end_block] = write_array[end_block:to_write]
         # Atomically increase the write pointer to make data handling easier
-        self.control_array[0] = (written + to_write) % self.length
+        self._write_pointer = (written + to_write) % self.length
+        self._control[0] = self._write_pointer
+        self.bytes_written += to_write
+        if to_write < len(write_array):
+            self.stalls += 1
         return to_write
 
     def bytes_available(self):
-        written = int(self._safe_control_read(0))
-        read = self._safe_control_read(1)
-        available = (written - read + self.length) % self.length
-        return available
+        written = self._safe_control_read(0)
+        return (written - self._read_pointer) % self.length
 
     def buffer_space(self):
-        written = int(self.control_array[0])
         read = self._safe_control_read(1)
-        available = (read - written - 1 + 2 * self.length) % self.length
-        return available
+        return (read - self._write_pointer - 1) % self.length
 
-    def read_upto(self, n=-1):
-        written = int(self._safe_control_read(0))
-        read = self.control_array[1]
-        available = (written - read + self.length) % self.length
+    def readinto(self, b):
+        """Reads as many bytes as are available, up to the size of the
+        writable buffer `b`, and returns the number of bytes read
+
+        """
+        read_array = memoryview(b).cast('B')
+        written = self._safe_control_read(0)
+        read = self._read_pointer
+        available = min((written - read) % self.length, len(read_array))
         if available == 0:
-            return b''
-        if n > 0 and available > n:
-            available = n
-        read_array = np.empty([available], dtype=np.uint8)
+            return 0
         end_block = min(available, self.length - read)
-        read_array[0:end_block] = self.data_array[read:read + end_block]
+        read_array[0:end_block] = self._data[read:read + end_block]
         if end_block < available:
             read_array[end_block:available] = \
-                self.data_array[0:available - end_block]
-        self.control_array[1] = (read + available) % self.length
-        return read_array.tobytes()
+                self._data[0:available - end_block]
+        self._read_pointer = (read + available) % self.length
+        self._control[1] = self._read_pointer
+        self.bytes_read += available
+        return available
+
+    def read_upto(self, n=-1):
+        if n < 0 or n > self.length:
+            n = self.length
+        data = bytearray(n)
+        count = self.readinto(data)
+        del data[count:]
+        return bytes(data)
 
     def read(self, n=-1):
-        data = self.read_upto(n)
-        while len(data) != n and n != -1:
-            assert(len(data) < n)
-            data += self.read_upto(n-len(data))
-        return data
+        if n < 0:
+            return self.read_upto(n)
+        data = bytearray(n)
+        view = memoryview(data)
+        count = 0
+        while count < n:
+            count += self.readinto(view[count:])
+        return bytes(data)
 
     def _safe_control_read(self, index):
-        last_value = self.control_array[index]
-        value = self.control_array[index]
+        last_value = self._control[index]
+        value = self._control[index]
         while value != last_value:
             last_value = value
-            value = self.control_array[index]
+            value = self._control[index]
         return value
 
+# Must match MAX_DESCRIPTOR in mailbox_io.c
+_MAX_CHANNELS = 10
+
+# Mailbox layer linked into programs that don't use the default layout.
+# The prebuilt BSPs fix the descriptors of mailbox_io.o at the default
+# layout so this defines every symbol of that object, keeping it from
+# being pulled in from libxil. It is otherwise the same as mailbox_io.c
+# in bsp_gen with the descriptor table generated from the layout.
+_mailbox_prelude = R"""
+#include <stdint.h>
+#include <errno.h>
+#include <unistd.h>
+#include <fcntl.h>
+#include <intrgpio.h>
+#include <mailbox_io.h>
+
+typedef struct {
+    void* base_addr;
+    int size;
+    int flags;
+} _mailbox_descriptor_t;
+"""
+
+_mailbox_source = R"""
+__attribute__((weak))
+void _handle_events() {
+}
+
+static void _mailbox_cpy(volatile char* dest, volatile char* src, int len) {
+    /* Copy whole words when both sides are aligned as it takes a
+       quarter of the BRAM accesses */
+    if ((((intptr_t)dest | (intptr_t)src) & 3) == 0) {
+        volatile int32_t* dest_word = (volatile int32_t*)dest;
+        volatile int32_t* src_word = (volatile int32_t*)src;
+        while (len >= 4) {
+            *dest_word++ = *src_word++;
+            len -= 4;
+        }
+        dest = (volatile char*)dest_word;
+        src = (volatile char*)src_word;
+    }
+    while (len-- > 0) {
+        *dest++ = *src++;
+    }
+}
+
+int mailbox_available(int file) {
+    if (file < 0 || file >= MAILBOX_MAX_DESCRIPTOR ||
+            _mailbox_descriptors[file].base_addr == NULL) {
+        errno = EBADF;
+        return -1;
+    }
+    volatile int32_t* ctrl =
+        (volatile int32_t*)_mailbox_descriptors[file].base_addr;
+    volatile int32_t* status = ctrl + 1;
+    int buf_size = _mailbox_descriptors[file].size;
+    int available = 0;
+    int read_stream = _mailbox_descriptors[file].flags == O_RDONLY;
+
+    /* The BRAM can produce rubbish when a read/write collision happens
+       so read twice to make sure that the available data is valid */
+    int last_available = 0xFFFF;
+    while (last_available != available) {
+        last_available = available;
+        if (read_stream) {
+            available = *ctrl - *status;
+        } else {
+            available = *status - *ctrl - 1;
+        }
+        if (available < 0) available += buf_size;
+    }
+    return available;
+}
+
+ssize_t mailbox_write(int file, const void* ptr, size_t len) {
+    if (file < 0 || file >= MAILBOX_MAX_DESCRIPTOR ||
+            _mailbox_descriptors[file].flags != O_WRONLY ||
+            _mailbox_descriptors[file].base_addr == NULL) {
+        errno = EBADF;
+        return -1;
+    }
+    volatile int32_t* ctrl =
+        (volatile int32_t*)_mailbox_descriptors[file].base_addr;
+    volatile char* buffer = (volatile char*)(ctrl + 2);
+    int buf_size = _mailbox_descriptors[file].size;
+
+    int available = mailbox_available(file);
+    while (available == 0) {
+        available = mailbox_available(file);
+        _handle_events();
+    }
+    int write_ptr = *ctrl;
+    int to_write = len < available ? len : available;
+    int first_block = to_write < (buf_size - write_ptr) ?
+        to_write : buf_size - write_ptr;
+    _mailbox_cpy(buffer + write_ptr, (char*)ptr, first_block);
+    if (first_block < to_write) {
+        _mailbox_cpy(buffer, (char*)ptr + first_block,
+                     to_write - first_block);
+    }
+    write_ptr += to_write;
+    if (write_ptr >= buf_size) write_ptr -= buf_size;
+    *ctrl = write_ptr;
+    if (file == STDOUT_FILENO) {
+        IntrGpio_RaiseInterrupt(0);
+    }
+    return to_write;
+}
+
+ssize_t mailbox_read(int file, void* ptr, size_t len) {
+    if (file < 0 || file >= MAILBOX_MAX_DESCRIPTOR ||
+            _mailbox_descriptors[file].flags != O_RDONLY ||
+            _mailbox_descriptors[file].base_addr == NULL) {
+        errno = EBADF;
+        return -1;
+    }
+    volatile int32_t* ctrl =
+        (volatile int32_t*)_mailbox_descriptors[file].base_addr;
+    volatile int32_t* status = ctrl + 1;
+    volatile char* buffer = (volatile char*)(ctrl + 2);
+    int buf_size = _mailbox_descriptors[file].size;
+
+    int available = mailbox_available(file);
+    while (available == 0) {
+        available = mailbox_available(file);
+        _handle_events();
+    }
+    int read_ptr = *status;
+    int to_read = len < available ? len : available;
+    int first_block = to_read < (buf_size - read_ptr) ?
+        to_read : buf_size - read_ptr;
+    _mailbox_cpy((char*)ptr, buffer + read_ptr, first_block);
+    if (first_block < to_read) {
+        _mailbox_cpy((char*)ptr + first_block, buffer,
+                     to_read - first_block);
+    }
+    read_ptr += to_read;
+    if (read_ptr >= buf_size) read_ptr -= buf_size;
+    *status = read_ptr;
+    return to_read;
+}
+
+int mailbox_open(const char* pathname, int flags, ...) {
+    int desc = 0;
+    while (desc < MAILBOX_MAX_DESCRIPTOR &&
+           _mailbox_descriptors[desc].base_addr) {
+        ++desc;
+    }
+    if (desc == MAILBOX_MAX_DESCRIPTOR) {
+        errno = ENFILE;
+        return -1;
+    }
+    _mailbox_descriptors[desc].base_addr = (void*)pathname;
+    _mailbox_descriptors[desc].flags = flags;
+    _mailbox_descriptors[desc].size = 0x7F8;
+    return desc;
+}
+
+int mailbox_close(int fd) {
+    _mailbox_descriptors[fd].base_addr = 0;
+    return 0;
+}
+
+void mailbox_outbyte(intptr_t device, char c) {
+    mailbox_write(1, &c, 1);
+}
+
+char mailbox_inbyte(intptr_t device) {
+    char c;
+    mailbox_read(0, &c, 1);
+    return c;
+}
+
+long mailbox_lseek(int fd, long offset, int whence) {
+    return ESPIPE;
+}
+
+ssize_t write(int file, const void* ptr, size_t len) {
+    return mailbox_write(file, ptr, len);
+}
+
+ssize_t read(int file, void* ptr, size_t len) {
+    return mailbox_read(file, ptr, len);
+}
+
+off_t lseek(int fd, off_t offset, int whence) {
+    return ESPIPE;
+}
+
+int open(const char* pathname, int flags, ...) {
+    return mailbox_open(pathname, flags);
+}
+
+int close(int fd) {
+    return mailbox_close(fd);
+}
+"""
+
+
+class MailboxLayout:
+    """Describes the channels carved out of the top of the Microblaze
+    memory
+
+    Channels are described by a list of (name, size, direction) tuples
+    where direction is 'in' for data sent to the Microblaze and 'out'
+    for data sent from it. The index of a channel in the list is the
+    file descriptor it uses on the Microblaze and the channels are
+    placed contiguously in order ending at `top`. The first four
+    channels are stdin, stdout and the RPC request and response
+    channels.
+
+    """
+    def __init__(self, channels, top=0x10000):
+        self.channels = [tuple(c) for c in channels]
+        self.top = top
+        if len(self.channels) > _MAX_CHANNELS:
+            raise RuntimeError(
+                f"At most {_MAX_CHANNELS} mailbox channels are supported")
+        names = [c[0] for c in self.channels]
+        if len(set(names)) != len(names):
+            raise RuntimeError("Mailbox channel names must be unique")
+        self._offsets = {}
+        offset = top - sum(c[1] for c in self.channels)
+        if offset < 0:
+            raise RuntimeError("Mailbox channels larger than memory")
+        self.base = offset
+        for name, size, direction in self.channels:
+            if size <= 8 or size % 4:
+                raise RuntimeError(
+                    f"Mailbox channel {name} must be a multiple of 4 bytes "
+                    "larger than 8")
+            if direction not in ('in', 'out'):
+                raise RuntimeError(
+                    f"Mailbox channel {name} direction must be 'in' or 'out'")
+            self._offsets[name] = offset
+            offset += size
+
+    def __eq__(self, other):
+        return (isinstance(other, MailboxLayout) and
+                self.channels == other.channels and self.top == other.top)
+
+    def __hash__(self):
+        return hash((tuple(self.channels), self.top))
+
+    def offset(self, name):
+        return self._offsets[name]
+
+    def size(self, name):
+        return self.channels[self.fd(name)][1]
+
+    def fd(self, name):
+        return [c[0] for c in self.channels].index(name)
+
+    def stream_args(self, read, write):
+        """Returns the keyword arguments to create a stream that reads
+        from channel `read` and writes to channel `write`
+
+        """
+        return {
+            'read_offset': self.offset(read),
+            'read_length': self.size(read),
+            'write_offset': self.offset(write),
+            'write_length': self.size(write)
+        }
+
+    def c_source(self):
+        """Returns C source of a mailbox layer with the descriptors
+        placed according to this layout, which replaces the one in the
+        prebuilt BSP
+
+        """
+        lines = [_mailbox_prelude,
+                 f'#define MAILBOX_MAX_DESCRIPTOR {_MAX_CHANNELS}',
+                 'static _mailbox_descriptor_t '
+                 '_mailbox_descriptors[MAILBOX_MAX_DESCRIPTOR] = {']
+        for name, size, direction in self.channels:
+            flags = 'O_RDONLY' if direction == 'in' else 'O_WRONLY'
+            lines.append(f'    {{(void*){hex(self.offset(name))}, '
+                         f'{hex(size - 8)}, {flags}}},')
+        lines.append('};')
+        lines.append(_mailbox_source)
+        return '\n'.join(lines)
+
+    def linker_script(self, script, reserve=0):
+        """Returns a copy of the linker script `script` with the memory
+        region shortened to end where the mailbox channels begin, less
+        `reserve` bytes kept free below the channels
+
+        """
+        match = re.search(
+            r'ORIGIN\s*=\s*(0x[0-9A-Fa-f]+|\d+)\s*,\s*LENGTH\s*=\s*'
+            r'(0x[0-9A-Fa-f]+|\d+)', script)
+        if not match:
+            raise RuntimeError("Could not find memory region in linker script")
+        origin = int(match.group(1), 0)
+        top = self.base - reserve
+        if top <= origin:
+            raise RuntimeError("Mailbox channels leave no room for the program")
+        return (script[:match.start(2)] + hex(top - origin) +
+                script[match.end(2):])
+
+
+DEFAULT_LAYOUT = MailboxLayout([
+    ('stdin', 0x400, 'in'),
+    ('stdout', 0x400, 'out'),
+    ('rpc_in', 0x400, 'in'),
+    ('rpc_out', 0x400, 'out')
+])
+
 _short_struct = struct.Struct('h')
 _ushort_struct = struct.Struct('H')
 _int_struct = struct.Struct('i')
@@ -112,15 +460,19 @@ _uint_struct = struct.Struct('I')
 _float_struct = struct.Struct('f')
 
 class SimpleMBStream:
-    def __init__(self, iop, read_offset=0xF400, write_offset=0xF000):
+    def __init__(self, iop, read_offset=0xF400, write_offset=0xF000,
+                 read_length=0x400, write_length=0x400):
         self.read_channel = SimpleMBChannel(iop.mmio.mem, offset=read_offset,
-                                            length=0x400)
+                                            length=read_length)
         self.write_channel = SimpleMBChannel(iop.mmio.mem, offset=write_offset,
-                                             length=0x400)
+                                             length=write_length)
 
     def read(self, n=-1):
         return self.read_channel.read(n)
 
+    def readinto(self, b):
+        return self.read_channel.readinto(b)
+
     def write(self, b):
         return self.write_channel.write(b)
 
@@ -178,11 +530,37 @@ class SimpleMBStream:
 
     def read_float(self):
         return _float_struct.unpack(self.read(4))[0]
+
+    def read_array(self, dtype, count):
+        """Reads `count` elements of `dtype` from the stream, blocking
+        until all of them have arrived
+
+        """
+        array = np.empty(count, dtype=np.dtype(dtype).newbyteorder('<'))
+        view = memoryview(array.view(np.uint8))
+        received = 0
+        while received < len(view):
+            received += self.read_channel.readinto(view[received:])
+        return array
+
+    def write_array(self, array):
+        """Writes the whole of `array` to the stream, blocking until
+        there is space in the channel
+
+        """
+        array = np.asarray(array)
+        array = np.ascontiguousarray(
+            array, dtype=array.dtype.newbyteorder('<'))
+        view = memoryview(array.view(np.uint8))
+        sent = 0
+        while sent < len(view):
+            sent += self.write_channel.write(view[sent:])
+        return sent
         
 
 class InterruptMBStream(SimpleMBStream):
-    def __init__(self, iop):
-        super().__init__(iop)
+    def __init__(self, iop, **kwargs):
+        super().__init__(iop, **kwargs)
         self.interrupt = iop.interrupt
 
     async def read_async(self):
@@ -192,3 +570,189 @@ class InterruptMBStream(SimpleMBStream):
             data = self.read()
             self.interrupt.clear()
         return data
+
+    async def read_exact_async(self, n):
+        data = self.read_channel.read_upto(n)
+        while len(data) < n:
+            await self.interrupt.wait()
+            self.interrupt.clear()
+            data += self.read_channel.read_upto(n - len(data))
+        return data
+
+
+_PUMP_POLICIES = ('drop_oldest', 'drop_newest', 'block')
+
+
+class StdoutPump:
+    """Drains a stream in a background thread so the Microblaze never
+    blocks waiting for the host to read its output
+
+    Output is split into lines and held in a buffer of at most
+    `max_bytes`. When the buffer is full the policy decides what
+    happens: 'drop_oldest' discards the oldest lines, 'drop_newest'
+    discards the incoming data and 'block' stops draining the stream
+    until space is freed, applying backpressure to the Microblaze. Lines
+    longer than `max_bytes` are split into pieces of at most `max_bytes`
+    which are buffered as separate lines. If a log file is given every
+    line is also appended to it regardless of the policy.
+
+    Attributes
+    ----------
+    bytes_received : int
+        Bytes drained from the stream
+    lines_received : int
+        Complete lines drained from the stream
+    dropped_bytes  : int
+        Bytes discarded because the buffer was full
+    dropped_lines  : int
+        Lines discarded because the buffer was full
+    stalls         : int
+        Times draining was paused by the 'block' policy
+
+    """
+    def __init__(self, stream, max_bytes=64 * 1024, policy='drop_oldest',
+                 log_file=None, poll_interval=0.001):
+        if policy not in _PUMP_POLICIES:
+            raise RuntimeError(f"Unknown pump policy {policy}")
+        self._channel = stream.read_channel
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.poll_interval = poll_interval
+        self._log = open(log_file, 'ab') if log_file else None
+        self._lines = collections.deque()
+        self._buffered = 0
+        self._partial = b''
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.bytes_received = 0
+        self.lines_received = 0
+        self.dropped_bytes = 0
+        self.dropped_lines = 0
+        self.stalls = 0
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        if self._log:
+            self._log.write(self._partial)
+            self._log.close()
+            self._log = None
+
+    def _run(self):
+        data = bytearray(self._channel.length)
+        view = memoryview(data)
+        stalled = False
+        while not self._stop.is_set():
+            space = len(data)
+            if self.policy == 'block':
+                space = min(space, self.max_bytes - self._buffered -
+                            len(self._partial))
+                if space <= 0:
+                    if not stalled:
+                        self.stalls += 1
+                        stalled = True
+                    time.sleep(self.poll_interval)
+                    continue
+            stalled = False
+            count = self._channel.readinto(view[:space])
+            if count:
+                self._receive(bytes(view[:count]))
+            else:
+                time.sleep(self.poll_interval)
+
+    def _receive(self, data):
+        self.bytes_received += len(data)
+        lines = (self._partial + data).split(b'\n')
+        self._partial = lines.pop()
+        lines = [l + b'\n' for l in lines]
+        self.lines_received += len(lines)
+        # Split long lines so that no line is larger than the buffer and
+        # flush a partial line once it reaches the size of the buffer
+        size = self.max_bytes
+        lines = [line[i:i + size] for line in lines
+                 for i in range(0, len(line), size)]
+        while len(self._partial) >= size:
+            lines.append(self._partial[:size])
+            self._partial = self._partial[size:]
+        if self._log and lines:
+            self._log.write(b''.join(lines))
+            self._log.flush()
+        with self._lock:
+            for line in lines:
+                if self._buffered + len(line) > self.max_bytes:
+                    if self.policy == 'drop_newest':
+                        self.dropped_lines += 1
+                        self.dropped_bytes += len(line)
+                        continue
+                    if self.policy == 'drop_oldest':
+                        while self._lines and \
+                                self._buffered + len(line) > self.max_bytes:
+                            old = self._lines.popleft()
+                            self._buffered -= len(old)
+                            self.dropped_lines += 1
+                            self.dropped_bytes += len(old)
+                self._lines.append(line)
+                self._buffered += len(line)
+
+    def readline(self):
+        """Returns the next complete line or b'' if there isn't one
+
+        """
+        with self._lock:
+            if not self._lines:
+                return b''
+            line = self._lines.popleft()
+            self._buffered -= len(line)
+            return line
+
+    def readlines(self):
+        """Returns all of the buffered complete lines
+
+        """
+        with self._lock:
+            lines = list(self._lines)
+            self._lines.clear()
+            self._buffered = 0
+            return lines
+
+    def read(self, n=-1):
+        """Returns the buffered complete lines, up to `n` bytes if
+        specified. Any trailing partial line is only returned once it
+        is completed.
+
+        """
+        if n < 0:
+            return b''.join(self.readlines())
+        with self._lock:
+            data = []
+            size = 0
+            while self._lines and size < n:
+                line = self._lines.popleft()
+                if size + len(line) > n:
+                    self._lines.appendleft(line[n - size:])
+                    line = line[:n - size]
+                    self._buffered -= len(line)
+                else:
+                    self._buffered -= len(line)
+                data.append(line)
+                size += len(line)
+            return b''.join(data)
+
+    def stats(self):
+        return {
+            'bytes_received': self.bytes_received,
+            'lines_received': self.lines_received,
+            'dropped_bytes': self.dropped_bytes,
+            'dropped_lines': self.dropped_lines,
+            'stalls': self.stalls,
+            'buffered': self._buffered,
+        }
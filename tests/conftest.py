@@ -0,0 +1,91 @@
+#   Copyright (c) 2016, Xilinx, Inc.
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+__author__ = "Peter Ogden"
+__copyright__ = "Copyright 2017, Xilinx"
+__email__ = "ogden@xilinx.com"
+
+import sys
+import types
+
+import pytest
+
+
+class FakePL:
+    """Stand-in for the PYNQ PL server which checks that every client
+    request is closed by a server update before the next one
+
+    """
+    def __init__(self):
+        self._ip_dict = {}
+        self.requests = 0
+        self.updates = 0
+        self.open = False
+
+    def client_request(self):
+        assert not self.open, "client_request without server_update"
+        self.open = True
+        self.requests += 1
+
+    def server_update(self):
+        assert self.open, "server_update without client_request"
+        self.open = False
+        self.updates += 1
+
+
+class FakePynqMicroblaze:
+    def __init__(self, mb_info, mb_program, force=False):
+        pass
+
+    def reset(self):
+        pass
+
+    def run(self):
+        pass
+
+
+# The tests run without a board so PYNQ is replaced when it is missing
+try:
+    import pynq
+except ImportError:
+    pynq = types.ModuleType('pynq')
+    pynq.PL = FakePL()
+    pynq.Xlnk = object
+    pynq.lib = types.ModuleType('pynq.lib')
+    pynq.lib.PynqMicroblaze = FakePynqMicroblaze
+    sys.modules['pynq'] = pynq
+    sys.modules['pynq.lib'] = pynq.lib
+
+
+@pytest.fixture
+def fake_pl(monkeypatch):
+    from ipython_microblaze import compile
+    pl = FakePL()
+    monkeypatch.setattr(compile, 'PL', pl)
+    return pl
@@ -0,0 +1,96 @@
+#   Copyright (c) 2016, Xilinx, Inc.
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+__author__ = "Peter Ogden"
+__copyright__ = "Copyright 2017, Xilinx"
+__email__ = "ogden@xilinx.com"
+
+import os
+import threading
+import time
+from os import path
+
+from ipython_microblaze.cache import FileCache
+
+
+def _store(cache, tmpdir, key, size=8):
+    source = tmpdir.join(f'source-{key}')
+    source.write_binary(bytes(size))
+    with cache.lock(key):
+        return cache.store(key, str(tmpdir), [source.basename])
+
+
+def test_evict_removes_lock_files(tmpdir):
+    cache = FileCache(str(tmpdir.join('cache')), max_size=10)
+    for key in 'abc':
+        _store(cache, tmpdir, key)
+    assert cache.evictions == 2
+    assert os.listdir(path.join(cache.root, '.locks')) == ['c']
+    cache.clear()
+    assert os.listdir(path.join(cache.root, '.locks')) == []
+
+
+def test_held_lock_is_kept(tmpdir):
+    cache = FileCache(str(tmpdir.join('cache')), max_size=1024)
+    _store(cache, tmpdir, 'a')
+    with cache.lock('a'):
+        cache.clear()
+        assert os.listdir(path.join(cache.root, '.locks')) == ['a']
+    cache.clear()
+    assert os.listdir(path.join(cache.root, '.locks')) == []
+
+
+def test_lock_survives_removed_file(tmpdir):
+    cache = FileCache(str(tmpdir.join('cache')), max_size=1024)
+    lock_file = path.join(cache.root, '.locks', 'a')
+    inside = []
+    waiting = threading.Event()
+
+    def waiter():
+        waiting.set()
+        with cache.lock('a'):
+            inside.append('waiter')
+            time.sleep(0.05)
+            inside.append('waiter done')
+
+    with cache.lock('a'):
+        thread = threading.Thread(target=waiter)
+        thread.start()
+        waiting.wait()
+        time.sleep(0.05)
+        # Somebody removes the file while the waiter is blocked on it
+        os.unlink(lock_file)
+        newcomer = cache.lock('a')
+        newcomer.__enter__()
+    # The waiter has to retry on the newcomer's file
+    time.sleep(0.05)
+    assert inside == []
+    newcomer.__exit__(None, None, None)
+    thread.join()
+    assert inside == ['waiter', 'waiter done']
@@ -0,0 +1,103 @@
+#   Copyright (c) 2016, Xilinx, Inc.
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+__author__ = "Peter Ogden"
+__copyright__ = "Copyright 2017, Xilinx"
+__email__ = "ogden@xilinx.com"
+
+from os import path
+
+import numpy as np
+import pytest
+
+from ipython_microblaze import compile
+from ipython_microblaze.streams import DEFAULT_LAYOUT
+
+
+class FakeMMIO:
+    def __init__(self):
+        self.written = 0
+
+    def write(self, offset, data):
+        self.written += len(data)
+
+
+def _entry(tmpdir, name, image):
+    entry = tmpdir.mkdir(name)
+    entry.join('a.bin').write_binary(image)
+    entry.join('a.out').write_binary(b'')
+    return str(entry)
+
+
+@pytest.fixture
+def program(tmpdir, fake_pl, monkeypatch):
+    monkeypatch.setattr(compile, '_trusted_pages',
+                        lambda elf, size: np.ones(size // 1024 + 1, dtype=bool))
+    mb = object.__new__(compile.MicroblazeProgram)
+    mb.ip_name = 'mb'
+    mb.mmio = FakeMMIO()
+    mb.interrupt = None
+    mb.pump = None
+    mb.reserve = 0
+    mb._mb_info = None
+    mb._bsp = None
+    mb.layout = DEFAULT_LAYOUT
+    mb._open_streams = lambda layout: None
+    old = _entry(tmpdir, 'old', bytes(8192))
+    mb._record_resident(old, DEFAULT_LAYOUT)
+    fake_pl._ip_dict['mb'] = {'state': path.join(old, 'a.bin')}
+    new = _entry(tmpdir, 'new', bytes(4096) + b'\x01' * 4096)
+    monkeypatch.setattr(compile, 'build_program',
+                        lambda *args: (new, True))
+    yield mb
+    compile._resident.pop('mb', None)
+
+
+def test_load_writes_changed_pages(program, fake_pl):
+    written = program.load('')
+    assert written < compile._MEMORY_SIZE
+    assert fake_pl.requests == fake_pl.updates == 1
+    assert not fake_pl.open
+    assert fake_pl._ip_dict['mb']['state'] == path.join(program.entry,
+                                                       'a.bin')
+
+
+def test_load_after_foreign_program(program, fake_pl):
+    fake_pl._ip_dict['mb']['state'] = '/elsewhere/a.bin'
+    written = program.load('')
+    assert written >= compile._MEMORY_SIZE
+    assert fake_pl.requests == fake_pl.updates == 1
+    assert not fake_pl.open
+
+
+def test_loaded_program_outlives_cache_entry(program, tmpdir):
+    program.load('')
+    tmpdir.join('new').remove()
+    assert path.exists(path.join(program.entry, 'a.bin'))
+    assert path.exists(path.join(program.entry, 'a.out'))
@@ -0,0 +1,63 @@
+#   Copyright (c) 2016, Xilinx, Inc.
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+__author__ = "Peter Ogden"
+__copyright__ = "Copyright 2017, Xilinx"
+__email__ = "ogden@xilinx.com"
+
+import shutil
+import subprocess
+
+import pytest
+
+from ipython_microblaze.bsp import BSPs
+
+_array_program = """
+#include <stdint.h>
+#include <mailbox_io.h>
+
+int32_t samples[256];
+
+int exchange(void) {
+    if (mailbox_read_array(0, samples, sizeof(samples)) < 0) return -1;
+    return mailbox_write_array(1, samples, sizeof(samples));
+}
+"""
+
+
+@pytest.mark.skipif(shutil.which('gcc') is None, reason="Needs gcc")
+@pytest.mark.parametrize('bsp', sorted(BSPs))
+def test_array_helpers_compile(bsp, tmpdir):
+    source = tmpdir.join('program.c')
+    source.write(_array_program)
+    args = ['gcc', '-Wall', '-Werror', '-c', '-o', str(tmpdir.join('a.o')),
+            str(source)]
+    for include_dir in BSPs[bsp].include_path:
+        args.extend(['-I', include_dir])
+    subprocess.run(args, check=True)
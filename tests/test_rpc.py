@@ -0,0 +1,156 @@
+#   Copyright (c) 2016, Xilinx, Inc.
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+__author__ = "Peter Ogden"
+__copyright__ = "Copyright 2017, Xilinx"
+__email__ = "ogden@xilinx.com"
+
+import asyncio
+import collections
+import struct
+import threading
+import types
+
+import pytest
+
+from ipython_microblaze import rpc
+from ipython_microblaze.streams import SimpleMBChannel
+from ipython_microblaze.streams import SimpleMBStream
+
+_REQUEST_OFFSET = 0xF800
+_RESPONSE_OFFSET = 0xFC00
+_CHANNEL_SIZE = 0x100
+
+
+class FakeServer:
+    """Serves `void tick(int)` from a thread, printing through an
+    interned format for every call like the pyprintf module does. Every
+    write blocks until the response channel has space.
+
+    """
+    def __init__(self, mem):
+        self.requests = SimpleMBChannel(mem, _REQUEST_OFFSET, _CHANNEL_SIZE)
+        self.responses = SimpleMBChannel(mem, _RESPONSE_OFFSET,
+                                         _CHANNEL_SIZE)
+        self.stop = threading.Event()
+        self.calls = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _read(self, n):
+        data = b''
+        while len(data) < n and not self.stop.is_set():
+            data += self.requests.read_upto(n - len(data))
+        return data
+
+    def _write(self, data):
+        while data and not self.stop.is_set():
+            data = data[self.responses.write(data):]
+
+    def _run(self):
+        format_string = b'.'
+        self._write(bytes([rpc._PRINTF_DEFINE]) +
+                    struct.pack('<HH', 0, len(format_string)) +
+                    format_string)
+        while not self.stop.is_set():
+            header = self._read(8)
+            if len(header) < 8:
+                return
+            command, length = struct.unpack('ii', header)
+            self._read(length & ~rpc._NOTIFY_FLAG)
+            if command == rpc._FENCE_COMMAND:
+                self._write(b'\x00')
+                continue
+            self.calls += 1
+            self._write(bytes([rpc._PRINTF_INTERNED]) +
+                        struct.pack('<HH', 0, 0))
+
+
+@pytest.fixture
+def server():
+    mem = bytearray(0x10000)
+    iop = types.SimpleNamespace(mmio=types.SimpleNamespace(mem=mem))
+    server = FakeServer(mem)
+    visitor = rpc.FuncDefVisitor()
+    visitor.visit(rpc._parser.parse('void tick(int n);', filename='<stdin>'))
+    instance = rpc.MicroblazeRPC.__new__(rpc.MicroblazeRPC)
+    instance._batch = None
+    instance.stats = None
+    instance.timeline = None
+    instance._arena_size = 0
+    instance._voids_sent = 0
+    instance._voids_done = 0
+    instance._posted_fences = collections.deque()
+    instance._async_lock = asyncio.Lock()
+    instance.spin_time = rpc.DEFAULT_SPIN_TIME
+    instance.sleep_time = rpc.DEFAULT_SLEEP_TIME
+    instance._rpc_stream = SimpleMBStream(
+        iop, read_offset=_RESPONSE_OFFSET, write_offset=_REQUEST_OFFSET,
+        read_length=_CHANNEL_SIZE, write_length=_CHANNEL_SIZE)
+    instance._build_functions(visitor.functions, {})
+    yield instance, server
+    server.stop.set()
+    server.thread.join()
+
+
+def _run_with_timeout(target, timeout=10):
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "Host and microblaze deadlocked"
+
+
+def test_void_calls_with_printf(server, capsys):
+    instance, fake = server
+    calls = 2000
+
+    def run():
+        for i in range(calls):
+            instance.tick(i)
+        instance.fence()
+
+    _run_with_timeout(run)
+    assert fake.calls == calls
+    assert instance.outstanding == 0
+    assert capsys.readouterr().out == '.' * calls
+
+
+def test_batched_void_calls_with_printf(server, capsys):
+    instance, fake = server
+    calls = 2000
+
+    def run():
+        with instance.batch():
+            for i in range(calls):
+                instance.tick(i)
+        instance.fence()
+
+    _run_with_timeout(run)
+    assert fake.calls == calls
+    assert capsys.readouterr().out == '.' * calls
@@ -0,0 +1,100 @@
+#   Copyright (c) 2016, Xilinx, Inc.
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+__author__ = "Peter Ogden"
+__copyright__ = "Copyright 2017, Xilinx"
+__email__ = "ogden@xilinx.com"
+
+import shutil
+import subprocess
+from os import path
+
+import pytest
+
+from ipython_microblaze.bsp import BSPs
+from ipython_microblaze.streams import MailboxLayout
+
+LAYOUT = MailboxLayout([
+    ('stdin', 0x400, 'in'),
+    ('stdout', 0x400, 'out'),
+    ('rpc_in', 0x2000, 'in'),
+    ('rpc_out', 0x2000, 'out'),
+    ('samples', 0x800, 'out')
+])
+
+needs_host_tools = pytest.mark.skipif(
+    shutil.which('gcc') is None or shutil.which('nm') is None,
+    reason="Needs gcc and nm")
+
+
+def _defined_symbols(nm_output, member=None):
+    symbols = set()
+    current = None
+    for line in nm_output.splitlines():
+        if line.endswith(':'):
+            current = line[:-1]
+        elif line.strip() and (member is None or current == member):
+            fields = line.split()
+            if len(fields) == 3 and fields[1] in 'TDW':
+                symbols.add(fields[2])
+    return symbols
+
+
+def test_layout_offsets():
+    assert LAYOUT.offset('samples') == 0xF800
+    assert LAYOUT.offset('stdin') == 0xB000
+    assert LAYOUT.base == LAYOUT.offset('stdin')
+
+
+def test_layout_too_large():
+    with pytest.raises(RuntimeError):
+        MailboxLayout([('stdin', 0x10008, 'in')])
+
+
+@needs_host_tools
+@pytest.mark.parametrize('bsp', sorted(BSPs))
+def test_mailbox_layer_replaces_bsp(bsp, tmpdir):
+    bsp = BSPs[bsp]
+    source = tmpdir.join('layer.c')
+    source.write(LAYOUT.c_source())
+    obj = str(tmpdir.join('layer.o'))
+    args = ['gcc', '-Wall', '-Werror', '-c', '-o', obj, str(source)]
+    for include_dir in bsp.include_path:
+        args.extend(['-I', include_dir])
+    subprocess.run(args, check=True)
+    defined = _defined_symbols(
+        subprocess.run(['nm', obj], check=True, stdout=subprocess.PIPE,
+                       universal_newlines=True).stdout)
+    archive = path.join(bsp.library_path[0], 'libxil.a')
+    bsp_symbols = _defined_symbols(
+        subprocess.run(['nm', archive], check=True, stdout=subprocess.PIPE,
+                       universal_newlines=True).stdout, 'mailbox_io.o')
+    # Anything left undefined would pull the BSP's copy in from libxil
+    assert bsp_symbols
+    assert bsp_symbols - {'descriptors'} <= defined